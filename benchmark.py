@@ -0,0 +1,206 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import timeit
+
+from draw3d import *
+
+
+# рендер-заглушка: ничего не рисует, только запоминает, сколько треугольников ему передали,
+# так Scene.draw измеряется без времени Tk
+class RecordRender(Render):
+    def __init__(self):
+        super().__init__()
+        self.frames = 0
+        self.triangles = 0
+
+    def clear_screen(self):
+        pass
+
+    def draw_tris(self, screen, depth, colors):
+        self.triangles += len(screen)
+
+    def present(self):
+        self.frames += 1
+
+
+# тор из сетки rows x cols клеток, примерно faces треугольников, без вырожденных граней
+def synthetic_mesh(faces, radius=100.0):
+    """
+    :return: вершины (N, 3) и треугольники (F, 3)
+    """
+    cols = max(3, int(sqrt(faces)))
+    rows = max(3, faces // (2 * cols))
+    u, v = np.meshgrid(np.linspace(0, 2 * pi, rows, endpoint=False), np.linspace(0, 2 * pi, cols, endpoint=False), indexing='ij')
+    ring = radius + radius / 3 * np.cos(v)
+    vertices = np.stack([ring * np.cos(u), radius / 3 * np.sin(v), ring * np.sin(u)], axis=-1).reshape(-1, 3)
+
+    # каждая клетка сетки - два треугольника, последние строка и столбец замыкаются на первые
+    r, c = np.meshgrid(np.arange(rows), np.arange(cols), indexing='ij')
+    a = r * cols + c
+    b = r * cols + (c + 1) % cols
+    d = (r + 1) % rows * cols + c
+    e = (r + 1) % rows * cols + (c + 1) % cols
+    faces = np.concatenate([np.stack([a, d, b], -1).reshape(-1, 3), np.stack([b, d, e], -1).reshape(-1, 3)])
+    return vertices, faces.astype(np.int32)
+
+
+# записать сетку в obj файл
+def write_obj(filename, vertices, faces):
+    with open(filename, 'w') as f:
+        np.savetxt(f, vertices, fmt='v %.6f %.6f %.6f')
+        np.savetxt(f, faces + 1, fmt='f %d %d %d')
+
+
+# время одного вызова fn в секундах: минимум и медиана по repeat замерам
+def measure(fn, repeat=5):
+    timer = timeit.Timer(fn)
+    # количество вызовов на замер подбирается так, чтобы замер длился не меньше 0.2 с
+    number, _ = timer.autorange()
+    times = sorted(t / number for t in timer.repeat(repeat, number))
+    return {'min': times[0], 'median': times[len(times) // 2], 'number': number}
+
+
+# замеры всех этапов конвейера на одной модели
+def bench_model(filename, repeat=5, optimize=False, dtype=np.float64):
+    mesh = ObjMesh(filename, optimize=optimize)
+    view = View(600, 400, d=100, persp=True)
+    view.transform.phi = 0.4
+    view.transform.teta = 0.7
+    scene = Scene(view, RecordRender(), dtype=dtype)
+    scene.add_object(mesh)
+
+    triangles, _ = mesh.get_geometry(view.transform)
+    transform = mesh.transform
+
+    # матрица кэшируется, поэтому перед каждой сборкой сбрасываем ее изменением параметра
+    def build_matrix():
+        transform.phi = transform.phi
+        return transform.matrix
+
+    # готовые треугольники тоже кэшируются, замеряем пересчет
+    # (только сброс кэша: invalidate() еще и заново считает нормали граней)
+    def get_geometry():
+        geometry_cache.invalidate(mesh)
+        return mesh.get_geometry(view.transform)
+
+    # повернуть заранее посчитанные нормали, как это делает сцена
+    def face_normals():
+        geometry_cache.discard(mesh, ('normals', 0))
+        tris, _ = mesh.get_geometry(view.transform)
+        return mesh.face_normals(view.transform, tris)
+
+    # кадр с движущейся камерой, как при управлении стрелками
+    def draw():
+        view.transform.teta += 0.001
+        scene.draw()
+
+    stages = {
+        'parse': lambda: mesh.parse(filename),
+        'transform_matrix': build_matrix,
+        'get_geometry': get_geometry,
+        'normal_calc': lambda: normal_calc(triangles),
+        'face_normals': face_normals,
+        'depth_sort': lambda: np.argsort(zorder(triangles), kind='stable'),
+        'to_screen': lambda: view.to_screen_batch(triangles),
+        'scene_draw': draw,
+    }
+    result = {'faces': len(mesh.faces), 'vertices': mesh.V.shape[1], 'optimize': mesh.optimize_stats,
+              'dtype': np.dtype(dtype).name, 'stages': {}}
+    for name, fn in stages.items():
+        result['stages'][name] = measure(fn, repeat)
+    return result
+
+
+# сведения о машине, на которой проводились замеры
+def environment():
+    return {
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+    }
+
+
+# сравнить результаты с сохраненными, вернуть список замедлений больше threshold
+def compare(results, baseline, threshold=0.1):
+    """
+    :param results: новые результаты
+    :param baseline: сохраненные результаты
+    :param threshold: допустимое относительное замедление, 0.1 - на 10%
+    :return: список (модель, этап, было, стало)
+    """
+    regressions = []
+    for model, data in results['models'].items():
+        old = baseline['models'].get(model)
+        if old is None:
+            continue
+        for stage, timing in data['stages'].items():
+            if stage not in old['stages']:
+                continue
+            before, after = old['stages'][stage]['min'], timing['min']
+            change = after / before - 1
+            mark = ''
+            if change > threshold:
+                mark = ' <- замедление'
+                regressions.append((model, stage, before, after))
+            print(f'{model:24} {stage:18} {before * 1e3:10.3f} ms {after * 1e3:10.3f} ms {change:+7.1%}{mark}')
+    return regressions
+
+
+# python benchmark.py -o bench.json
+# python benchmark.py --sizes 100000 1000000 4000000 --compare bench.json
+# python benchmark.py --optimize --compare bench.json
+# python benchmark.py --dtype float32 --compare bench.json
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Замеры скорости этапов 3d конвейера без окна')
+    parser.add_argument('models', nargs='*', default=['pyramid.obj', 'sphere.obj', 'teddy.obj'], help='obj файлы моделей')
+    parser.add_argument('--sizes', type=int, nargs='*', default=[10000, 100000, 1000000],
+                        help='количество треугольников синтетических моделей')
+    parser.add_argument('--repeat', type=int, default=5, help='количество замеров каждого этапа')
+    parser.add_argument('--optimize', action='store_true',
+                        help='оптимизировать сетки после загрузки, для сравнения с замерами без оптимизации')
+    parser.add_argument('--dtype', choices=['float64', 'float32'], default='float64', help='точность геометрии сцены')
+    parser.add_argument('-o', '--output', help='записать результаты в json файл')
+    parser.add_argument('--compare', metavar='BASELINE', help='сравнить с сохраненными результатами')
+    parser.add_argument('--threshold', type=float, default=0.1, help='допустимое замедление, 0.1 - на 10%%')
+    args = parser.parse_args(argv)
+
+    results = {'environment': environment(), 'models': {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        files = [(os.path.basename(model), model) for model in args.models]
+        for size in args.sizes:
+            filename = os.path.join(tmp, f'synthetic_{size}.obj')
+            write_obj(filename, *synthetic_mesh(size))
+            files.append((f'synthetic_{size}', filename))
+
+        for name, filename in files:
+            results['models'][name] = data = bench_model(filename, args.repeat, args.optimize, args.dtype)
+            if data['optimize']:
+                opt = data['optimize']
+                print(f'{name}: вершин {opt["vertices_before"]} -> {opt["vertices_after"]}, '
+                      f'треугольников {opt["faces_before"]} -> {opt["faces_after"]}')
+            stages = ', '.join(f'{stage} {t["min"] * 1e3:.3f}' for stage, t in data['stages'].items())
+            print(f'{name} ({data["faces"]} треугольников), ms: {stages}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f'замедлений больше {args.threshold:.0%}: {len(regressions)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,12 @@
+import hashlib
+import itertools
+import os
+import struct
+import threading
+import time
+import weakref
+import zlib
+from collections import OrderedDict, deque
 import numpy as np
 from math import *
 
@@ -15,8 +24,8 @@ class Render:
     def draw_quad(self, p1, p2, p3, p4, color):
         raise NotImplemented()
 
-    # текст
-    def draw_text(self, x, y, color, font):
+    # текст, (x, y) - левый верхний угол
+    def draw_text(self, x, y, text, color, font=None):
         raise NotImplemented()
 
     # линия
@@ -27,6 +36,29 @@ class Render:
     def clear_screen(self):
         raise NotImplemented()
 
+    # нужно ли сортировать треугольники по глубине перед рисованием (алгоритм художника)
+    needs_sort = True
+
+    # сколько вызовов отрисовки ушло в Tk (или другую библиотеку) с момента создания
+    draw_calls = 0
+
+    # сразу много треугольников: экранные координаты (N, 3, 2), глубина вершин (N, 3), цвета (N, 3)
+    def draw_tris(self, screen, depth, colors):
+        # по вызову на каждый треугольник
+        self.draw_calls += len(screen)
+        for p, color in zip(screen.tolist(), colors.tolist()):
+            self.draw_tri(p[0], p[1], p[2], color)
+
+            # рисуем красный wireframe, для отладки
+            # red = (255, 0, 0)
+            # self.draw_line(p[0], p[1], 1, red)
+            # self.draw_line(p[1], p[2], 1, red)
+            # self.draw_line(p[2], p[0], 1, red)
+
+    # кадр нарисован, показать его
+    def present(self):
+        pass
+
 
 # конвертировать цвет из hex в rgb '#FF00FF -> np.array(255, 0, 255)
 def hex_to_rgb(color):
@@ -62,10 +94,402 @@ class CanvasRender(Render):
     def draw_quad(self, p1, p2, p3, p4, color):
         self.canvas.create_polygon(p1[0], p1[1], p2[0], p2[1], p3[0], p3[1], p4[0], p4[1], fill=rgb_to_hex(color))
 
+    def draw_text(self, x, y, text, color, font=None):
+        self.canvas.create_text(x, y, text=text, fill=rgb_to_hex(color), font=font, anchor='nw')
+
     def clear_screen(self):
         self.canvas.delete('all')
 
 
+# таблицы hex строк цветов по количеству бит на канал, общие для всех рисователей
+_color_tables = {}
+
+
+# таблица '#rrggbb' для всех цветов с bits битами на канал, индекс - (r << 2 * bits) | (g << bits) | b
+def color_table(bits):
+    table = _color_tables.get(bits)
+    if table is None:
+        levels = 1 << bits
+        # уровень растягивается обратно на 0..255, старшие биты повторяются в младших: 63 -> 255
+        values = np.arange(levels) * 255 // (levels - 1)
+        channel = np.array([f'{v:02x}' for v in values])
+        r = np.char.add('#', channel)[:, None, None]
+        table = np.char.add(np.char.add(r, channel[None, :, None]), channel[None, None, :]).ravel()
+        _color_tables[bits] = table
+    return table
+
+
+# hex строки для массива цветов (N, 3) через таблицу, без форматирования каждого цвета
+def colors_to_hex(colors, bits=6):
+    q = np.asarray(colors).astype(np.int32) >> (8 - bits)
+    return color_table(bits)[(q[:, 0] << 2 * bits) | (q[:, 1] << bits) | q[:, 2]]
+
+
+# рисователь для Canvas, который собирает весь кадр в один Tcl скрипт и отдает его Tk одним вызовом
+# при present(), вместо вызова create_polygon из Python на каждый треугольник
+class BatchCanvasRender(CanvasRender):
+    def __init__(self, canvas, color_bits=6):
+        """
+        :param canvas: Canvas, на котором рисуется кадр
+        :param color_bits: бит на канал цвета, цвета округляются до 2 ** color_bits уровней
+        """
+        super().__init__(canvas)
+        self.color_bits = color_bits
+        # Tcl команда Canvas, например .!canvas
+        self.path = str(canvas)
+        # куски скрипта текущего кадра
+        self.script = []
+        # цикл по треугольникам внутри процедуры компилируется Tcl один раз, а не разбирается построчно каждый кадр
+        canvas.tk.eval(self.polygons_proc)
+
+    # процедура Tcl: data - плоский список x1 y1 x2 y2 x3 y3 цвет для каждого треугольника
+    polygons_proc = ('proc draw3d_polygons {canvas data} {\n'
+                     '    foreach {x1 y1 x2 y2 x3 y3 fill} $data {$canvas create polygon $x1 $y1 $x2 $y2 $x3 $y3 -fill $fill}\n'
+                     '}\n')
+
+    def draw_tri(self, p1, p2, p3, color):
+        self.script.append(f'{self.path} create polygon {p1[0]} {p1[1]} {p2[0]} {p2[1]} {p3[0]} {p3[1]} '
+                           f'-fill {rgb_to_hex(color)}\n')
+
+    def draw_line(self, p1, p2, width, color):
+        self.script.append(f'{self.path} create line {p1[0]} {p1[1]} {p2[0]} {p2[1]} -width {width} '
+                           f'-fill {rgb_to_hex(color)}\n')
+
+    def draw_quad(self, p1, p2, p3, p4, color):
+        self.script.append(f'{self.path} create polygon {p1[0]} {p1[1]} {p2[0]} {p2[1]} {p3[0]} {p3[1]} '
+                           f'{p4[0]} {p4[1]} -fill {rgb_to_hex(color)}\n')
+
+    def draw_text(self, x, y, text, color, font=None):
+        # текст и шрифт нужно экранировать для Tcl, это делает tkinter, поэтому сначала отдаем накопленное
+        self.flush()
+        super().draw_text(x, y, text, color, font)
+
+    def draw_tris(self, screen, depth, colors):
+        n = len(screen)
+        if not n:
+            return
+        # Canvas все равно рисует в целых пикселях
+        rows = np.empty((n, 7), dtype=object)
+        rows[:, :6] = np.rint(screen.reshape(n, 6)).astype(np.int32)
+        rows[:, 6] = colors_to_hex(colors, self.color_bits)
+        # в данных только числа и цвета, поэтому список можно передать в фигурных скобках без экранирования
+        data = ('%d %d %d %d %d %d %s ' * n) % tuple(rows.ravel().tolist())
+        self.script.append(f'draw3d_polygons {self.path} {{{data}}}\n')
+
+    def clear_screen(self):
+        # удаление старого кадра уходит в Tk вместе с новым, окно не успевает показать пустой Canvas
+        self.script = [f'{self.path} delete all\n']
+
+    # выполнить накопленный скрипт
+    def flush(self):
+        if self.script:
+            self.canvas.tk.eval(''.join(self.script))
+            self.draw_calls += 1
+            self.script = []
+
+    def present(self):
+        self.flush()
+
+
+# рисователь для Canvas, который не удаляет объекты между кадрами,
+# а переиспользует многоугольники и линии, созданные в прошлых кадрах
+class RetainedCanvasRender(CanvasRender):
+    def __init__(self, canvas):
+        super().__init__(canvas)
+        # все созданные объекты Canvas по типам, в порядке создания
+        self.pool = {'polygon': [], 'line': [], 'text': []}
+        # сколько объектов каждого типа использовано в текущем кадре
+        self.used = {'polygon': 0, 'line': 0, 'text': 0}
+        # сколько объектов каждого типа было видно в прошлом кадре
+        self.shown = {'polygon': 0, 'line': 0, 'text': 0}
+        # текущие параметры объектов, чтобы не вызывать itemconfigure без необходимости
+        self.options = {}
+        # объект, нарисованный в прошлом кадре непосредственно перед данным
+        self.below = {}
+        # последний нарисованный в текущем кадре объект
+        self.last = None
+        # порядок наложения в текущем кадре разошелся с прошлым кадром
+        self.restack = False
+
+    def _item(self, kind, coords, **options):
+        pool = self.pool[kind]
+        n = self.used[kind]
+        self.used[kind] += 1
+
+        if n < len(pool):
+            item = pool[n]
+            self.canvas.coords(item, *coords)
+
+            changed = {k: v for k, v in options.items() if self.options[item].get(k) != v}
+            self.options[item].update(changed)
+            # объект был спрятан в прошлом кадре
+            if n >= self.shown[kind]:
+                changed['state'] = 'normal'
+            if changed:
+                self.canvas.itemconfigure(item, **changed)
+
+            # пока объекты идут в том же порядке, что и в прошлом кадре, порядок наложения уже правильный
+            if self.restack or self.below.get(item) != self.last:
+                self.restack = True
+                if self.last is None:
+                    self.canvas.tag_lower(item)
+                else:
+                    self.canvas.tag_raise(item, self.last)
+        else:
+            # новый объект создается поверх всех остальных
+            item = getattr(self.canvas, 'create_' + kind)(*coords, **options)
+            pool.append(item)
+            self.options[item] = options
+            self.restack = True
+
+        self.below[item] = self.last
+        self.last = item
+
+    def draw_tri(self, p1, p2, p3, color):
+        self._item('polygon', (p1[0], p1[1], p2[0], p2[1], p3[0], p3[1]), fill=rgb_to_hex(color))
+
+    def draw_line(self, p1, p2, width, color):
+        self._item('line', (p1[0], p1[1], p2[0], p2[1]), width=width, fill=rgb_to_hex(color))
+
+    def draw_quad(self, p1, p2, p3, p4, color):
+        self._item('polygon', (p1[0], p1[1], p2[0], p2[1], p3[0], p3[1], p4[0], p4[1]), fill=rgb_to_hex(color))
+
+    def draw_text(self, x, y, text, color, font=None):
+        self._item('text', (x, y), text=text, fill=rgb_to_hex(color), font=font, anchor='nw')
+
+    def clear_screen(self):
+        # ничего не удаляем, объекты будут переиспользованы в новом кадре
+        for kind in self.used:
+            self.used[kind] = 0
+        self.last = None
+        self.restack = False
+
+    def present(self):
+        # лишние объекты, оставшиеся от прошлого кадра, не удаляем, а прячем
+        for kind, pool in self.pool.items():
+            for item in pool[self.used[kind]:self.shown[kind]]:
+                self.canvas.itemconfigure(item, state='hidden')
+            self.shown[kind] = self.used[kind]
+
+
+# программный растеризатор с z-буфером, рисует кадр в np.array (h, w, 3)
+# время кадра зависит от количества пикселей, а не от количества объектов на Canvas
+class ZBufferRender(Render):
+    # перекрытие граней решает z-буфер, сортировка не нужна
+    needs_sort = False
+
+    def __init__(self, w, h, canvas=None, bg=(0, 255, 0), chunk=1 << 20):
+        """
+        :param w: ширина кадра в пикселях
+        :param h: высота кадра в пикселях
+        :param canvas: Canvas, на который выводится готовый кадр, None - кадр только в self.frame
+        :param bg: цвет фона
+        :param chunk: сколько пикселей-кандидатов обрабатывать за один проход
+        """
+        super().__init__()
+        self.w = w
+        self.h = h
+        self.canvas = canvas
+        self.bg = np.asarray(hex_to_rgb(bg), dtype=np.uint8)
+        self.chunk = chunk
+        # цвет и глубина для каждого пикселя
+        self.frame = np.empty((h, w, 3), dtype=np.uint8)
+        self.depth = np.empty((h, w))
+        self.photo = None
+        # надписи текущего кадра и объекты Canvas, которыми они выводятся поверх картинки
+        self.texts = []
+        self.text_items = []
+        self.clear_screen()
+
+    def clear_screen(self):
+        self.frame[:] = self.bg
+        # чем больше z, тем ближе точка к наблюдателю
+        self.depth.fill(-np.inf)
+        self.texts = []
+
+    def draw_tri(self, p1, p2, p3, color):
+        # глубина не известна, рисуем поверх всего, что уже нарисовано
+        self.draw_tris(np.array([[p1, p2, p3]]), None, np.array([hex_to_rgb(color)]))
+
+    def draw_quad(self, p1, p2, p3, p4, color):
+        self.draw_tri(p1, p2, p4, color)
+        self.draw_tri(p2, p3, p4, color)
+
+    def draw_line(self, p1, p2, width, color):
+        # линия толщиной в один пиксель, без проверки глубины
+        n = int(max(abs(p2[0] - p1[0]), abs(p2[1] - p1[1]))) + 1
+        x = np.rint(np.linspace(p1[0], p2[0], n)).astype(int)
+        y = np.rint(np.linspace(p1[1], p2[1], n)).astype(int)
+        ok = (x >= 0) & (x < self.w) & (y >= 0) & (y < self.h)
+        self.frame[y[ok], x[ok]] = hex_to_rgb(color)
+
+    # шрифтов в numpy нет, поэтому текст выводится объектами Canvas поверх кадра,
+    # без canvas текст не рисуется и в get_frame()/save() не попадает
+    def draw_text(self, x, y, text, color, font=None):
+        self.texts.append(((x, y), dict(text=text, fill=rgb_to_hex(color), font=font, anchor='nw')))
+
+    def draw_tris(self, screen, depth, colors):
+        """
+        :param screen: экранные координаты вершин (N, 3, 2)
+        :param depth: z-координаты вершин (N, 3), None - рисовать поверх всего
+        :param colors: цвета треугольников (N, 3)
+        """
+        screen = np.asarray(screen, dtype=np.int64)
+        colors = np.clip(colors, 0, 255).astype(np.uint8)
+
+        x = screen[..., 0]
+        y = screen[..., 1]
+        # удвоенная площадь со знаком, знак зависит от порядка обхода вершин
+        area = (x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0]) - (x[:, 2] - x[:, 0]) * (y[:, 1] - y[:, 0])
+
+        # описывающий прямоугольник, обрезанный по краям экрана
+        xmin = np.maximum(x.min(1), 0)
+        xmax = np.minimum(x.max(1), self.w - 1)
+        ymin = np.maximum(y.min(1), 0)
+        ymax = np.minimum(y.max(1), self.h - 1)
+
+        # выбрасываем вырожденные треугольники и те, что целиком за экраном
+        ids = np.flatnonzero((area != 0) & (xmin <= xmax) & (ymin <= ymax))
+        if len(ids) == 0:
+            return
+
+        # группируем треугольники по размеру прямоугольника (степени двойки),
+        # чтобы обработать каждую группу одной сеткой пикселей
+        kx = np.ceil(np.log2(xmax[ids] - xmin[ids] + 1)).astype(int)
+        ky = np.ceil(np.log2(ymax[ids] - ymin[ids] + 1)).astype(int)
+        keys = kx * 64 + ky
+        for key in np.unique(keys):
+            group = ids[keys == key]
+            sx, sy = 1 << (key // 64), 1 << (key % 64)
+            gx, gy = np.meshgrid(np.arange(sx), np.arange(sy))
+            gx = gx.ravel()
+            gy = gy.ravel()
+
+            step = max(1, self.chunk // (sx * sy))
+            for i in range(0, len(group), step):
+                self._fill(group[i:i + step], gx, gy, x, y, area, depth, colors, xmin, xmax, ymin, ymax)
+
+    def _fill(self, ids, gx, gy, x, y, area, depth, colors, xmin, xmax, ymin, ymax):
+        # координаты пикселей-кандидатов, по строке на треугольник
+        px = xmin[ids, np.newaxis] + gx
+        py = ymin[ids, np.newaxis] + gy
+        inside = (px <= xmax[ids, np.newaxis]) & (py <= ymax[ids, np.newaxis])
+
+        x0, x1, x2 = (x[ids, k, np.newaxis] for k in range(3))
+        y0, y1, y2 = (y[ids, k, np.newaxis] for k in range(3))
+        a = area[ids, np.newaxis]
+        # барицентрические координаты без деления на площадь
+        e0 = (x1 - px) * (y2 - py) - (x2 - px) * (y1 - py)
+        e1 = (x2 - px) * (y0 - py) - (x0 - px) * (y2 - py)
+        e2 = a - e0 - e1
+        sign = np.sign(a)
+        inside &= (e0 * sign >= 0) & (e1 * sign >= 0) & (e2 * sign >= 0)
+
+        row, col = np.nonzero(inside)
+        tri = ids[row]
+        pix = py[row, col] * self.w + px[row, col]
+        if depth is None:
+            z = np.full(len(tri), np.inf)
+        else:
+            # глубина интерполируется линейно по экрану
+            z = (e0[row, col] * depth[tri, 0] + e1[row, col] * depth[tri, 1] + e2[row, col] * depth[tri, 2]) / a[row, 0]
+
+        # для каждого пикселя оставляем самую близкую точку,
+        # при равной глубине побеждает треугольник, нарисованный позже
+        order = np.lexsort((-tri, -z, pix))
+        pix, z, tri = pix[order], z[order], tri[order]
+        first = np.ones(len(pix), dtype=bool)
+        first[1:] = pix[1:] != pix[:-1]
+        pix, z, tri = pix[first], z[first], tri[first]
+
+        zbuf = self.depth.reshape(-1)
+        frame = self.frame.reshape(-1, 3)
+        win = z >= zbuf[pix]
+        zbuf[pix[win]] = z[win]
+        frame[pix[win]] = colors[tri[win]]
+
+    # копия готового кадра в виде np.array (h, w, 3)
+    def get_frame(self):
+        return self.frame.copy()
+
+    def present(self):
+        if self.canvas is None:
+            return
+
+        from tkinter import PhotoImage
+
+        # кадр передается в Tk одной картинкой в формате PPM
+        ppm = ppm_bytes(self.frame)
+        if self.photo is None:
+            self.photo = PhotoImage(master=self.canvas, width=self.w, height=self.h)
+            self.canvas.create_image(0, 0, image=self.photo, anchor='nw')
+        self.photo.configure(data=ppm, format='PPM')
+        self.draw_calls += 1
+
+        # надписи переиспользуют объекты прошлого кадра, лишние удаляются
+        for i, (coords, options) in enumerate(self.texts):
+            if i < len(self.text_items):
+                self.canvas.coords(self.text_items[i], *coords)
+                self.canvas.itemconfigure(self.text_items[i], **options)
+            else:
+                self.text_items.append(self.canvas.create_text(*coords, **options))
+            self.draw_calls += 1
+        for item in self.text_items[len(self.texts):]:
+            self.canvas.delete(item)
+        del self.text_items[len(self.texts):]
+
+    # сохранить кадр в файл .png или .ppm
+    def save(self, filename):
+        write_image(filename, self.frame)
+
+
+# кадр np.array (h, w, 3) в формате PPM
+def ppm_bytes(frame):
+    h, w, _ = frame.shape
+    return b'P6 %d %d 255\n' % (w, h) + np.ascontiguousarray(frame, dtype=np.uint8).tobytes()
+
+
+# кадр np.array (h, w, 3) в формате PNG, без сторонних библиотек
+def png_bytes(frame):
+    h, w, _ = frame.shape
+    # каждая строка начинается с байта фильтра, 0 - без фильтра
+    raw = np.zeros((h, w * 3 + 1), dtype=np.uint8)
+    raw[:, 1:] = frame.reshape(h, w * 3)
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)) +
+            chunk(b'IEND', b''))
+
+
+# сохранить кадр в файл, формат выбирается по расширению: .png или .ppm
+def write_image(filename, frame):
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.png':
+        data = png_bytes(frame)
+    elif ext == '.ppm':
+        data = ppm_bytes(frame)
+    else:
+        raise ValueError(f'неизвестный формат картинки {ext}, нужен .png или .ppm')
+    with open(filename, 'wb') as f:
+        f.write(data)
+
+
+# номер последнего изменения любого transform или связей между объектами в деревьях сцены,
+# пока он не изменился, проверенные матрицы объектов (Object3D.world) действительны
+_tree_changes = itertools.count(1)
+_tree_version = 0
+
+
+def _tree_changed():
+    # next() у счетчика атомарен, поэтому каждое изменение получает новый номер
+    global _tree_version
+    _tree_version = next(_tree_changes)
+
+
 # класс-помощник для работы с матрицами аффинных преобразований
 class Transform:
     def __init__(self, x=0.0, y=0.0, z=0.0, phi=0.0, teta=0.0, psi=0.0, sx=1.0, sy=1.0, sz=1.0):
@@ -77,6 +501,10 @@ class Transform:
         :param teta: угол вращения по оси Y
         :param psi: угол вращения по оси Z
         """
+        # номер версии параметров, увеличивается при каждом изменении
+        self.version = 0
+        # собранная матрица и версия параметров, из которых она собрана
+        self._matrix = None, -1
         self.x = x
         self.y = y
         self.z = z
@@ -87,48 +515,149 @@ class Transform:
         self.sy = sy
         self.sz = sz
 
+    # параметры, от которых зависит матрица преобразования
+    params = ('x', 'y', 'z', 'phi', 'teta', 'psi', 'sx', 'sy', 'sz')
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        # при изменении любого параметра собранная матрица устаревает,
+        # версия увеличивается после записи значения: матрица, которую в это время собирает другой поток,
+        # окажется записана со старой версией и будет пересобрана
+        if name in self.params:
+            object.__setattr__(self, 'version', self.version + 1)
+        # версию можно увеличить и напрямую, например Instances.update
+        if name in self.params or name == 'version':
+            _tree_changed()
+
     @property
     def matrix(self):
         """
         Собрать все преобразования в одну матрицу 4x4
+        Матрица пересобирается только после изменения параметров, иначе возвращается готовая
         """
-        # масштабирование
-        scale = np.diag([self.sx, self.sy, self.sz, 1.0])
-        # добавляем вращение
-        t = self.rot * scale.T
-        # добавляем смещение
-        t[3, :3] = np.array([self.x, self.y, self.z])
-        
-        return t
+        matrix, version = self._matrix
+        if version != self.version:
+            version = self.version
+            # масштабирование
+            scale = np.diag([self.sx, self.sy, self.sz, 1.0])
+            # добавляем вращение
+            t = self.rot @ scale.T
+            # добавляем смещение
+            t[3, :3] = np.array([self.x, self.y, self.z])
+            # матрица общая для всех, кто ее запросил, менять ее нельзя
+            t.flags.writeable = False
+            matrix = t
+            self._matrix = matrix, version
+
+        return matrix
+
+    # во сколько раз матрица может удлинить вектор (спектральная норма части 3x3): поворот длину не меняет
+    @property
+    def stretch(self):
+        return max(fabs(self.sx), fabs(self.sy), fabs(self.sz))
 
     @property
     def rot(self):
         """
         Преобразовать углы эйлера (teta, phi, pis) в матрицу вращения
         """
-        x = np.matrix([[1, 0, 0, 0],
-                       [0, cos(self.phi), -sin(self.phi), 0],
-                       [0, sin(self.phi), cos(self.phi), 0],
-                       [0, 0, 0, 1]])
-
-        y = np.matrix([[cos(self.teta), 0, sin(self.teta), 0],
-                       [0, 1, 0, 0],
-                       [-sin(self.teta), 0, cos(self.teta), 0],
-                       [0, 0, 0, 1]])
-        z = np.matrix([[cos(self.psi), -sin(self.psi), 0, 0],
-                       [sin(self.psi), cos(self.psi), 0, 0],
-                       [0, 0, 1, 0],
-                       [0, 0, 0, 1]])
-
-        return x*y*z
+        x = np.array([[1, 0, 0, 0],
+                      [0, cos(self.phi), -sin(self.phi), 0],
+                      [0, sin(self.phi), cos(self.phi), 0],
+                      [0, 0, 0, 1]])
+
+        y = np.array([[cos(self.teta), 0, sin(self.teta), 0],
+                      [0, 1, 0, 0],
+                      [-sin(self.teta), 0, cos(self.teta), 0],
+                      [0, 0, 0, 1]])
+        z = np.array([[cos(self.psi), -sin(self.psi), 0, 0],
+                      [sin(self.psi), cos(self.psi), 0, 0],
+                      [0, 0, 1, 0],
+                      [0, 0, 0, 1]])
+
+        return x @ y @ z
+
+
+# кэш преобразованной геометрии объектов с ограничением по памяти,
+# при переполнении выбрасываются данные объектов, которые дольше всех не запрашивались
+class GeometryCache:
+    def __init__(self, max_bytes=128 << 20):
+        """
+        :param max_bytes: сколько байт массивов можно хранить, 0 - ничего не хранить
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        # (id объекта, ключ) -> (слабая ссылка на объект, отметка версии, массивы, размер)
+        self.entries = OrderedDict()
+        # кадры могут готовиться в фоновом потоке (FrameWorker), а объекты удаляться в любом,
+        # RLock - потому что сборщик мусора может удалить объект прямо внутри put()
+        self.lock = threading.RLock()
+
+    def get(self, owner, key, stamp):
+        """
+        :param owner: объект, которому принадлежат данные
+        :param key: что именно хранится, например уровень детализации
+        :param stamp: отметка версии, данные с другой отметкой устарели
+        :return: сохраненные массивы или None
+        """
+        with self.lock:
+            entry = self.entries.get((id(owner), key))
+            if entry is None or entry[0]() is not owner or entry[1] != stamp:
+                return None
+            self.entries.move_to_end((id(owner), key))
+            return entry[2]
+
+    def put(self, owner, key, stamp, arrays):
+        size = sum(a.nbytes for a in arrays)
+        for a in arrays:
+            a.flags.writeable = False
+
+        # после удаления объекта его данные удаляются из кэша
+        cid = id(owner)
+        ref = weakref.ref(owner, lambda _, cid=cid: self.invalidate_id(cid))
+        with self.lock:
+            self.discard(owner, key)
+            if size > self.max_bytes:
+                return
+            self.entries[cid, key] = (ref, stamp, arrays, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, _, _, old) = self.entries.popitem(last=False)
+                self.nbytes -= old
+
+    def discard(self, owner, key):
+        with self.lock:
+            entry = self.entries.pop((id(owner), key), None)
+            if entry is not None:
+                self.nbytes -= entry[3]
+
+    # выбросить все данные объекта
+    def invalidate(self, owner):
+        self.invalidate_id(id(owner))
+
+    def invalidate_id(self, cid):
+        with self.lock:
+            for k in [k for k in self.entries if k[0] == cid]:
+                self.nbytes -= self.entries.pop(k)[3]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+
+# общий для всех объектов кэш геометрии
+geometry_cache = GeometryCache()
 
 
 # параметры камеры/ наблюдателя
 class View:
-    def __init__(self,  w=400, h=300, d=200, persp=False):
+    def __init__(self,  w=400, h=300, d=200, persp=False, offset=500):
         """
         :param w: ширина в пикселях
         :param h: высота в пикселях
+        :param d: константа для перспективного преобразования
+        :param offset: смещение камеры по оси z для перспективного преобразования
         :persp: включить/выключить перспективные преобразования
         """
 
@@ -138,31 +667,84 @@ class View:
         self.h = h
         self.persp = persp
         self.d = d
+        self.offset = offset
 
     def to_screen(self, points):
-        res = []
-        for v in points:
-            x, y, z = v
-            d = self.distance
-            # требуется перспективное преобразование
-            if self.persp:
-                z = z-500
-                if z == 0:
-                    z = 1
-                f = self.d/z
-                x = int(x*f) + self.w//2
-                y = int(y*f) + self.h//2
-            else:
-                x = int(x) + self.w//2
-                y = int(y) + self.h//2
-            res.append((x, y))
+        return [tuple(p) for p in self.to_screen_batch(np.asarray(points)).tolist()]
+
+    def to_screen_batch(self, points, d=None, offset=None):
+        """
+        Перевести в экранные координаты сразу весь массив точек, например (N, 3, 3) для N треугольников
+        :param points: np.array формы (..., 3)
+        :param d: константа для перспективного преобразования, по-умолчанию self.d
+        :param offset: смещение камеры по оси z, по-умолчанию self.offset
+        :return: np.array целых экранных координат формы (..., 2)
+        """
+        if d is None:
+            d = self.d
+        if offset is None:
+            offset = self.offset
+
+        xy = points[..., 0:2]
+        # требуется перспективное преобразование
+        if self.persp:
+            z = points[..., 2] - offset
+            z[z == 0] = 1
+            xy = xy * (d / z)[..., np.newaxis]
+
+        # int() отбрасывает дробную часть, astype делает то же самое
+        res = xy.astype(int)
+        res[..., 0] += self.w//2
+        res[..., 1] += self.h//2
         return res
 
+    # радиус сферы на экране в пикселях, inf - камера внутри сферы
+    def projected_radius(self, center, radius):
+        if not self.persp:
+            return radius
+        z = center[2] - self.offset
+        if z + radius >= 0:
+            return inf
+        return radius * self.d / -z
+
+    def sphere_visibility(self, center, radius):
+        """
+        Положение сферы (в координатах камеры) относительно видимой области
+        :return: -1 - целиком вне экрана или за камерой, 0 - пересекает границу, 1 - целиком видна
+        """
+        x, y, z = center
+        if self.persp:
+            # камера находится в z = offset и смотрит в сторону уменьшения z
+            z = z - self.offset
+            if z - radius >= 0:
+                return -1
+            # расстояния до четырех боковых плоскостей, положительные - снаружи
+            nx = sqrt(self.d ** 2 + (self.w / 2) ** 2)
+            ny = sqrt(self.d ** 2 + (self.h / 2) ** 2)
+            dist = (max(x, -x) * self.d + self.w / 2 * z) / nx, (max(y, -y) * self.d + self.h / 2 * z) / ny
+            inside = z + radius < 0
+        else:
+            dist = fabs(x) - self.w / 2, fabs(y) - self.h / 2
+            inside = True
+
+        if max(dist) > radius:
+            return -1
+        if inside and max(dist) <= -radius:
+            return 1
+        return 0
+
+
+# номера версий положения объектов в дереве сцены, уникальные в пределах процесса
+_world_versions = itertools.count()
+
 
-# базовый класс для 3d объектов
+# базовый класс для любых 3d объектов
+# объекты образуют дерево: transform дочернего объекта задан в координатах родителя
 class Object3D:
     def __init__(self, pos=None, rot=None, scale=None, color=(255, 255, 255)):
         self.color = color
+        self.parent = None
+        self.children = []
 
         # задаем координаты объекта по-умолчанию
         if pos is None:
@@ -179,51 +761,354 @@ class Object3D:
         # устанавливаем матрицу трансформации для объекта
         self.transform = Transform(pos[0], pos[1], pos[2], rot[0], rot[1], rot[2], scale[0], scale[1], scale[2])
 
-    # преобразовать геометрию объекта в примитивы(треугольники) для рисования, в формате (список индексов, z-координата, цвет)
+    # ограничивающая сфера в собственных координатах объекта,
+    # бесконечный радиус - размер не известен, объект считается видимым всегда
+    center = np.zeros(3)
+    radius = inf
+
+    # добавить дочерний объект, если у него уже есть родитель, объект переносится
+    def add_child(self, obj):
+        if obj.parent is not None:
+            obj.parent.remove_child(obj)
+        obj.parent = self
+        self.children.append(obj)
+        _tree_changed()
+        return obj
+
+    def remove_child(self, obj):
+        self.children.remove(obj)
+        obj.parent = None
+        _tree_changed()
+
+    # сам объект и все его потомки, родители раньше детей
+    def walk(self):
+        stack = [self]
+        while stack:
+            obj = stack.pop()
+            yield obj
+            stack.extend(reversed(obj.children))
+
+    # корень дерева, в котором находится объект
+    @property
+    def root(self):
+        obj = self
+        while obj.parent is not None:
+            obj = obj.parent
+        return obj
+
+    # сохраненная матрица в координаты корня:
+    # ((родитель, его версия, версия transform), матрица, версия, корень, номер изменений дерева при проверке,
+    #  во сколько раз матрица может удлинить вектор - точно при равномерном масштабе, иначе с запасом)
+    _world = None
+
+    def world(self):
+        """
+        Матрица из координат объекта в координаты корня дерева: произведение transform всех объектов
+        от этого до корня, не включая сам корень. Каждый объект хранит свою матрицу и пересобирает ее,
+        только если изменились его transform или матрица родителя, поэтому после изменения одного объекта
+        пересчитывается только его поддерево
+        :return: матрица 4x4 (None для корня) и версия, которая меняется при любом изменении положения объекта,
+                 в том числе при изменении transform корня
+        """
+        cached = self._checked_world()
+        return cached[1], cached[2]
+
+    def _checked_world(self):
+        # номер изменений читается раньше transform, как версия в Transform.matrix:
+        # изменение во время проверки будет замечено при следующем вызове
+        checked = _tree_version
+        cached = self._world
+        if cached is not None and cached[4] == checked:
+            return cached
+        # поднимаемся до ближайшего предка, проверенного после последнего изменения, и проверяем матрицы
+        # сверху вниз, без рекурсии: в кадре каждый объект проверяется один раз, а не на каждого потомка
+        chain = []
+        obj = self
+        while obj is not None and (obj._world is None or obj._world[4] != checked):
+            chain.append(obj)
+            obj = obj.parent
+        for obj in reversed(chain):
+            obj._update_world(checked)
+        return self._world
+
+    # пересобрать матрицу, если изменился transform объекта или матрица родителя (уже проверенного)
+    def _update_world(self, checked):
+        # версия читается раньше матрицы, как и в Transform.matrix
+        own = self.transform.version
+        parent = self.parent
+        if parent is None:
+            key = None, -1, own
+            parent_matrix, root = None, self
+        else:
+            _, parent_matrix, parent_version, root, _, parent_stretch = parent._world
+            key = parent, parent_version, own
+
+        cached = self._world
+        if cached is None or cached[0] != key:
+            if parent is None:
+                matrix, stretch = None, 1.0
+            elif parent_matrix is None:
+                matrix, stretch = self.transform.matrix, self.transform.stretch
+            else:
+                matrix, stretch = self.transform.matrix @ parent_matrix, self.transform.stretch * parent_stretch
+                matrix.flags.writeable = False
+            self._world = key, matrix, next(_world_versions), root, checked, stretch
+        else:
+            self._world = key, cached[1], cached[2], root, checked, cached[5]
+
+    @property
+    def world_version(self):
+        return self._checked_world()[2]
+
+    def combined(self, transform: Transform = None):
+        """
+        Матрица из координат объекта в координаты камеры.
+        Видовая матрица применяется в координатах корня дерева: составной объект поворачивается вместе с камерой целиком
+        :param transform: видовое преобразование, None - без него
+        """
+        _, matrix, _, root, _, _ = self._checked_world()
+        M = root.transform.matrix
+        if transform is not None:
+            M = transform.matrix @ M
+        return M if matrix is None else matrix @ M
+
+    # матрица из координат объекта в координаты сцены без видового преобразования
+    @property
+    def world_matrix(self):
+        return self.combined()
+
+    def bounds(self):
+        """
+        Где может оказаться геометрия объекта при любом видовом преобразовании.
+        Видовая матрица применяется раньше матрицы корня, поэтому объект остается в точке position корня,
+        а его точки удалены от нее не больше, чем на reach * |поворот/масштаб вида| + scale * |смещение вида|
+        Пересчитывается только после изменения положения объекта
+        :return: position, reach, scale
+        """
+        _, matrix, key, root, _, stretch = self._checked_world()
+        if getattr(self, '_bounds_key', None) != key:
+            center, radius = self.center, self.radius
+            # сфера объекта в координатах корня (норма матрицы берется из world, без svd)
+            if matrix is not None:
+                center, radius = center @ matrix[:3, :3] + matrix[3, :3], radius * stretch
+            M = root.transform.matrix
+            scale = root.transform.stretch
+            self._bounds = M[3, :3], scale * (sqrt((center ** 2).sum()) + radius), scale
+            self._bounds_key = key
+        return self._bounds
+
+    # ограничивающая сфера после видового преобразования transform
+    def sphere(self, transform: Transform):
+        M = self.combined(transform)
+        return self.center @ M[:3, :3] + M[3, :3], self.radius * np.linalg.norm(M[:3, :3], 2)
+
+    def __getstate__(self):
+        # версии уникальны только внутри процесса, в другом процессе все пересчитывается заново
+        state = self.__dict__.copy()
+        state.pop('_world', None)
+        state.pop('_bounds_key', None)
+        # слабую ссылку сохранить нельзя
+        state.pop('_geometry_matrix', None)
+        return state
+
+    # уровень детализации для текущего вида, 0 - полная сетка
+    def select_lod(self, view, detail):
+        return 0
+
+    # хранить геометрию в точности dtype (np.float32 или np.float64), сцена вызывает при добавлении объекта
+    def set_dtype(self, dtype):
+        pass
+
+    # нормали треугольников, полученных из get_geometry(transform, level),
+    # и маска вырожденных треугольников (None - не известна, сцена найдет их по nan в нормалях)
+    def face_normals(self, transform: Transform, triangles, level=0):
+        return normal_calc(triangles), None
+
+    # преобразовать геометрию объекта и получить треугольники
     def get_geometry(self, transform: Transform):
         raise NotImplemented()
 
 
+# пустой объект без геометрии: общий родитель для частей составной модели, например сустав
+class Group(Object3D):
+    radius = 0.0
+
+    def get_geometry(self, transform: Transform):
+        return np.zeros((0, 3, 3)), np.zeros((0, 3), dtype=np.uint8)
+
+
 # объект, состоящий из многоугольников
 class Poly3D(Object3D):
-    def __init__(self, xyz, polys, pos=None, rot=None, scale=None, color=(255, 255, 255)):
+    def __init__(self, xyz, polys, pos=None, rot=None, scale=None, color=(255, 255, 255), dtype=np.float64):
         """
-        :param xyz: списки координат точек
-        :param polys: грани в формате [0, 1, 2, color]
+        :param xyz: списки координат точек или np.array формы (3, N)
+        :param polys: грани в формате [(0, 1, 2), color] или np.array индексов формы (F, 3)
         :param pos: позиция объекта на сцене [x, y, z]
         :param rot: вращение объекта [phi, teta, psi]
-        :param color: цвет граней по умолчанию
+        :param color: цвет граней, если polys передан как массив индексов
+        :param dtype: точность вершин, массив xyz такого типа не копируется (например отображенный в память)
         """
         super().__init__(pos, rot, scale, color)
-        x, y, z = xyz
-        # переводим координаты в вид, удобный для перемножения на матрицу 4x4
-        self.V = np.array([x, y, z, [1] * len(x)])
-        self.polys = polys
-
-    # получаем список треугольников для отрисовки
-    def get_geometry(self, transform: Transform):
-        if transform is None:
-            M = self.transform.matrix
+        # координаты точек (3, N), смещение из матрицы 4x4 прибавляется отдельно, без строки единиц
+        if isinstance(xyz, np.ndarray) and xyz.dtype == dtype and xyz.ndim == 2 and len(xyz) == 3:
+            self.V = xyz
+        else:
+            self.V = np.array(xyz, dtype=dtype).reshape(3, -1)
+
+        # ограничивающая сфера: центр описанного параллелепипеда и самая дальняя от него точка
+        if self.V.shape[1]:
+            self.center = (self.V.min(1) + self.V.max(1)) / 2
+            self.radius = float(np.sqrt(((self.V.T - self.center) ** 2).sum(1).max()))
+
+        # грани и их цвета храним в компактных массивах, один раз при создании объекта
+        if isinstance(polys, np.ndarray):
+            # индексы вершин для каждого треугольника, форма (F, 3)
+            # (без копирования, если массив уже int32, например отображенный в память)
+            self.faces = polys.astype(np.int32, copy=False).reshape(-1, 3)
+            # цвета треугольников, форма (F, 3), один цвет на все грани без выделения памяти
+            self.colors = np.broadcast_to(np.asarray(hex_to_rgb(color), dtype=np.uint8), (len(self.faces), 3))
         else:
-            # перемножаем собственное преобразование объекта с видовым
-            M = transform.matrix * self.transform.matrix
+            self.faces = np.array([p[0] for p in polys], dtype=np.int32).reshape(-1, 3)
+            # все цвета из hex конвертируем в rgb
+            self.colors = np.array([hex_to_rgb(p[1]) for p in polys], dtype=np.uint8).reshape(-1, 3)
 
+        # единичные нормали граней в пространстве модели, в кадре они только поворачиваются матрицей
+        self.normals = mesh_normals(self.V, self.faces)
+        # вырожденные грани (нулевой площади) отмечаются один раз, их нормали - nan
+        self.degenerate = np.isnan(self.normals[:, 0])
 
-        points = (self.V.T * M)[:, 0:3]
+    # упрощенные копии сетки, каждая следующая в 1/ratio раз меньше по числу треугольников
+    lods = ()
+    # на уровнях детализации не меньше стольких треугольников
+    lod_min_faces = 32
 
-        # получаем список готовых треугольников с координатами каждой точки
-        # p[0] - список граней для каждого треугольника в self.polys, например (0, 1, 2)
-        # points[(0, 1, 2), :] - из списка points получаем координаты точек для треугольника
-        # np.concatenate - получам np.array из списка списков точек
-        # .reshape(len(self.polys), 3, 3) приводит его к следующей форме
-        # [[[0,0,0], [0, 1, 0.5], [1, 1, 1]], ...]
-        triangles = np.concatenate([np.array(points[p[0], :]) for p in self.polys]).reshape(len(self.polys), 3, 3)
+    def build_lod(self, levels=3, ratio=0.25):
+        """
+        Построить упрощенные копии сетки
+        :param levels: количество уровней, уровни меньше lod_min_faces треугольников не строятся
+        :param ratio: во сколько раз меньше треугольников на каждом следующем уровне
+        """
+        targets = [int(len(self.faces) * ratio ** (i + 1)) for i in range(levels)]
+        targets = [t for t in targets if t >= self.lod_min_faces]
+        self.set_lod(simplify_mesh(self.V.T, self.faces, targets, self.colors))
 
-        # все цвета из hex конвертируем в rgb
-        colors = [hex_to_rgb(p[1]) for p in self.polys]
+    def set_lod(self, meshes):
+        """
+        :param meshes: список (vertices (N, 3), faces (F, 3), colors (F, 3) или None), от подробной к грубой,
+                       в self.lods уровни хранятся как (V (3, N), faces, colors, normals, degenerate)
+        """
+        self.lods = []
+        for vertices, faces, colors in meshes:
+            faces = faces.astype(np.int32, copy=False).reshape(-1, 3)
+            if colors is None:
+                # один цвет на всю сетку, как и у полной модели
+                colors = np.broadcast_to(self.colors[:1], (len(faces), 3))
+            # нормали считаются в float64, потом вершины и нормали приводятся к точности полной сетки
+            V = np.asarray(vertices, dtype=np.float64).T
+            normals = mesh_normals(V, faces)
+            self.lods.append((V.astype(self.V.dtype, copy=False), faces, colors, normals.astype(self.V.dtype, copy=False),
+                              np.isnan(normals[:, 0])))
+        geometry_cache.invalidate(self)
+
+    def set_dtype(self, dtype):
+        # вершины и нормали (и уровней детализации тоже) хранятся в dtype,
+        # нормали приводятся из уже посчитанных, а не пересчитываются в меньшей точности
+        dtype = np.dtype(dtype)
+        if self.V.dtype == dtype:
+            return
+        self.V = self.V.astype(dtype)
+        self.normals = self.normals.astype(dtype)
+        self.lods = [(V.astype(dtype), faces, colors, normals.astype(dtype), degenerate)
+                     for V, faces, colors, normals, degenerate in self.lods]
+        geometry_cache.invalidate(self)
+
+    # забыть сохраненную геометрию и пересчитать нормали, нужно после изменения self.V, self.faces или self.colors напрямую
+    def invalidate(self):
+        self.normals = mesh_normals(self.V, self.faces)
+        self.degenerate = np.isnan(self.normals[:, 0])
+        geometry_cache.invalidate(self)
+
+    # (уровень, слабая ссылка на треугольники, матрица) последнего вызова get_geometry
+    _geometry_matrix = None
+
+    # по этой отметке видно, что преобразования объекта или вида изменились
+    def _stamp(self, transform):
+        return self.world_version, transform, None if transform is None else transform.version
+
+    def select_lod(self, view, detail):
+        """
+        Самый грубый уровень, у которого треугольников не меньше, чем detail на каждый пиксель площади объекта на экране
+        :param view: настройки камеры
+        :param detail: треугольников на квадратный пиксель
+        """
+        if not self.lods:
+            return 0
+        size = view.projected_radius(*self.sphere(view.transform))
+        need = detail * pi * size ** 2
+        level = 0
+        for faces in (len(lod[1]) for lod in self.lods):
+            if faces < need:
+                break
+            level += 1
+        return level
 
+    # получаем список треугольников для отрисовки
+    def get_geometry(self, transform: Transform, level=0):
+        """
+        :param transform: видовое преобразование
+        :param level: уровень детализации, 0 - полная сетка, иначе self.lods[level - 1]
+        """
+        V, faces, colors = self.lods[level - 1][:3] if level else (self.V, self.faces, self.colors)
+
+        # ни объект, ни вид не менялись - треугольники уже посчитаны
+        stamp = self._stamp(transform)
+        cached = geometry_cache.get(self, ('triangles', level), stamp)
+        if cached is not None:
+            self._geometry_matrix = level, weakref.ref(cached[0]), cached[1]
+            return cached[0], colors
+
+        # перемножаем собственное преобразование объекта (и его родителей) с видовым
+        M = self.combined(transform)
+        # матрица собирается в float64, а точки считаются в точности вершин
+        T = M.astype(V.dtype, copy=False)
+
+        # преобразуем все точки фигуры: поворот и масштаб, потом смещение
+        points = V.T @ T[:3, :3]
+        points += T[3, :3]
+
+        # получаем массив готовых треугольников с координатами каждой точки
+        # np.take(points, faces, axis=0) - для каждой тройки индексов берем координаты точек
+        # (то же, что points[faces], только быстрее) и получаем массив следующей формы (F, 3, 3)
+        # [[[0,0,0], [0, 1, 0.5], [1, 1, 1]], ...]
+        triangles = np.take(points, faces, axis=0)
+
+        # вместе с треугольниками запоминаем матрицу, по ней face_normals повернет нормали,
+        # и отдельно от кэша - для сеток, которые в него не помещаются
+        self._geometry_matrix = level, weakref.ref(triangles), M
+        geometry_cache.put(self, ('triangles', level), stamp, (triangles, M))
         return triangles, colors
 
+    def face_normals(self, transform: Transform, triangles, level=0):
+        # вырожденные грани известны заранее, после невырожденного преобразования других не появляется
+        source, degenerate = self.lods[level - 1][3:] if level else (self.normals, self.degenerate)
+        stamp = self._stamp(transform)
+        cached = geometry_cache.get(self, ('normals', level), stamp)
+        if cached is not None:
+            return cached[0], degenerate
+        # нормали поворачиваем той же матрицей, что и треугольники
+        # (другой поток мог изменить transform или вызвать get_geometry между get_geometry и face_normals)
+        last = self._geometry_matrix
+        if last is None or last[0] != level or last[1]() is not triangles:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return normal_calc(triangles), None
+        normals = transform_normals(source, last[2][:3, :3])
+        if normals is None:
+            # вырожденная матрица (нулевой масштаб): нормали считаются по самим треугольникам
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return normal_calc(triangles), None
+        geometry_cache.put(self, ('normals', level), stamp, (normals, ))
+        return normals, degenerate
+
 
 # звезда
 class Star(Poly3D):
@@ -296,35 +1181,1052 @@ class Cube(Poly3D):
                  (7, 2, 6),
                  (0, 5, 1),
                  (0, 4, 5)]
-        polys = [(t,color) for t in polys]
+        polys = [(t, color) for t in polys]
 
         super().__init__([Wx, Wy, Wz], polys, pos, rot, scale)
 
 
+# модель из obj файла
+class ObjMesh(Poly3D):
+    def __init__(self, filename, pos=None, rot=None, scale=None, color=(255, 200, 0), cache=False, workers=1, lod=0,
+                 optimize=False, dtype=np.float64):
+        """
+        :param filename: obj файл или двоичный файл модели .mesh
+        :param cache: хранить рядом с obj файлом двоичную копию .mesh и открывать ее вместо разбора текста,
+                      упрощенные копии модели тоже сохраняются на диск
+        :param workers: сколько процессов разбирают obj файл, None - по количеству ядер
+        :param lod: сколько упрощенных копий модели построить для отрисовки издалека
+        :param optimize: склеить вершины и переставить грани после загрузки (см. optimize_mesh),
+                         число - расстояние, на котором вершины склеиваются
+        :param dtype: точность вершин, с np.float32 вершины файла .mesh не копируются, а остаются отображенными в память
+        """
+        if filename.endswith(MESH_EXT):
+            points, polys = self.load(filename)
+        elif cache:
+            points, polys = self.load(cached_mesh(filename, workers))
+        else:
+            points, polys = self.parse(filename, workers)
+        # количество вершин и граней до и после оптимизации
+        self.optimize_stats = None
+        if optimize:
+            tolerance = 1e-6 if optimize is True else optimize
+            vertices, polys, _, self.optimize_stats = optimize_mesh(points.T, polys, tolerance=tolerance)
+            points = vertices.T
+        super().__init__(points, np.asarray(polys), pos, rot, scale, color, dtype)
+
+        if lod and (cache or filename.endswith(MESH_EXT)):
+            self.set_lod(cached_lod(filename, lod, self.V.T, self.faces, min_faces=self.lod_min_faces))
+        elif lod:
+            self.build_lod(lod)
+
+    # открыть двоичный файл модели, данные не копируются, а отображаются в память
+    def load(self, filename):
+        vertices, tris = load_mesh(filename)
+        return vertices.T, tris
+
+    def parse(self, filename, workers=1):
+        if workers == 1:
+            with open(filename, 'rb') as f:
+                vertices, tris = parse_obj(f.read())
+        else:
+            vertices, tris = parse_obj_parallel(filename, workers)
+        return vertices.T, tris
+
+
+# много копий одной сетки: вершины и грани общие, у каждой копии своя матрица и свой цвет
+# все копии преобразуются одним матричным умножением
+class Instances(Object3D):
+    def __init__(self, mesh: Poly3D, matrices=None, colors=None, pos=None, rot=None, scale=None):
+        """
+        :param mesh: общая сетка, ее массивы не копируются
+        :param matrices: матрицы копий формы (K, 4, 4) или список Transform
+        :param colors: цвета копий формы (K, 3), None - цвета граней сетки
+        :param pos: позиция всей группы на сцене [x, y, z]
+        :param rot: вращение всей группы [phi, teta, psi]
+        """
+        super().__init__(pos, rot, scale)
+        self.V = mesh.V
+        self.faces = mesh.faces
+        self.mesh_colors = mesh.colors
+        self.mesh_center = mesh.center
+        self.mesh_radius = mesh.radius
+        self.set_matrices(np.zeros((0, 4, 4)) if matrices is None else matrices, colors)
+
+    def set_matrices(self, matrices, colors=None):
+        """
+        Заменить все копии
+        :param matrices: матрицы копий формы (K, 4, 4) или список Transform
+        :param colors: цвета копий формы (K, 3), None - цвета граней сетки
+        """
+        if not isinstance(matrices, np.ndarray):
+            matrices = [t.matrix if isinstance(t, Transform) else t for t in matrices]
+        self.matrices = np.array(matrices, dtype=np.float64).reshape(-1, 4, 4)
+        self.colors = None if colors is None else np.array([hex_to_rgb(c) for c in colors], dtype=np.uint8).reshape(-1, 3)
+        self.update()
+
+    # добавить копию
+    def add(self, pos=None, rot=None, scale=None, color=None):
+        t = Object3D(pos, rot, scale).transform
+        self.matrices = np.concatenate([self.matrices, t.matrix[np.newaxis]])
+        if color is not None and self.colors is None:
+            self.colors = np.broadcast_to(self.mesh_colors[0], (len(self.matrices) - 1, 3))
+        if self.colors is not None:
+            rgb = self.mesh_colors[0] if color is None else hex_to_rgb(color)
+            self.colors = np.concatenate([self.colors, np.array([rgb], dtype=np.uint8)])
+        self.update()
+
+    # пересчитать ограничивающую сферу группы, вызывать после изменения self.matrices напрямую
+    def update(self):
+        if len(self.matrices) and self.mesh_radius != inf:
+            # сферы всех копий и сфера, в которую они помещаются
+            centers = self.mesh_center @ self.matrices[:, :3, :3] + self.matrices[:, 3, :3]
+            radii = self.mesh_radius * np.linalg.norm(self.matrices[:, :3, :3], 2, axis=(1, 2))
+            self.center = (centers.min(0) + centers.max(0)) / 2
+            self.radius = float((np.sqrt(((centers - self.center) ** 2).sum(1)) + radii).max())
+        else:
+            self.center = np.zeros(3)
+            self.radius = inf if len(self.matrices) else 0.0
+        # для сцены изменение копий - то же, что перемещение объекта: сфера и BVH пересчитываются
+        self._bounds_key = None
+        self.transform.version += 1
+
+    def set_dtype(self, dtype):
+        # своя копия вершин, массив общей сетки не меняется
+        self.V = self.V.astype(dtype, copy=False)
+
+    def get_geometry(self, transform: Transform):
+        # перемножаем собственное преобразование группы (и ее родителей) с видовым
+        M = self.combined(transform)
+
+        # матрицы всех копий (K, 4, 4), потом все точки всех копий сразу (K, N, 3)
+        # матрица копии применяется первой, как transform дочернего объекта в Object3D.combined,
+        # поэтому сфера из update() и позиция группы согласованы с геометрией
+        M = (self.matrices @ M).astype(self.V.dtype, copy=False)
+        points = self.V.T @ M[:, :3, :3]
+        points += M[:, np.newaxis, 3, :3]
+
+        # треугольники (K, F, 3, 3) склеиваем в один массив (K * F, 3, 3)
+        # (np.take по оси вершин заметно быстрее индексации points[:, self.faces])
+        triangles = np.take(points, self.faces, axis=1).reshape(-1, 3, 3)
+        if self.colors is None:
+            colors = np.broadcast_to(self.mesh_colors, (len(self.matrices), ) + self.mesh_colors.shape).reshape(-1, 3)
+        else:
+            colors = np.repeat(self.colors, len(self.faces), axis=0)
+        return triangles, colors
+
+
+# разобрать содержимое obj файла целиком, без цикла по строкам на python
+# парсим только два вида данных - точка и грань, остальное игнорим
+# v 2.229345 -0.992723 -0.862826
+# f 25 20 22
+# f 1/1/1 2/2/2 3/3/3 4/4/4
+def parse_obj(data, relative=False):
+    """
+    :param data: содержимое obj файла (bytes)
+    :param relative: вернуть также номера элементов tris.ravel(), посчитанных из отрицательных индексов,
+        они отсчитываются от первой вершины в data (нужно при разборе файла по частям)
+    :return: вершины np.array (N, 3) и треугольники np.array (F, 3) с индексами от нуля
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    # пустой файл - пустая модель
+    if not len(buf):
+        vertices, tris = np.zeros((0, 3)), np.zeros((0, 3), dtype=np.int32)
+        return (vertices, tris, np.zeros(0, dtype=np.int64)) if relative else (vertices, tris)
+
+    # начало и длина каждой строки
+    starts = np.concatenate(([0], np.flatnonzero(buf == ord('\n')) + 1))
+    lengths = np.diff(np.concatenate((starts, [len(buf)])))
+
+    # комментарии до конца строки ("f 1 2 3 # грань") заменяем пробелами, перевод строки остается
+    hashes = np.flatnonzero(buf == ord('#'))
+    if len(hashes):
+        # первый '#' в каждой строке, где он есть
+        line, first = np.unique(np.searchsorted(starts, hashes, side='right') - 1, return_index=True)
+        ends = starts[line] + lengths[line]
+        ends -= buf[ends - 1] == ord('\n')
+        mark = np.zeros(len(buf) + 1, dtype=np.int8)
+        mark[hashes[first]] = 1
+        mark[ends] = -1
+        buf = buf.copy()
+        buf[np.cumsum(mark[:-1], dtype=np.int8).astype(bool)] = ord(' ')
+
+    # тип записи определяют первые два символа строки после пробелов в ее начале: "  v 0 0 0"
+    filled = np.flatnonzero((buf != ord(' ')) & (buf != ord('\t')))
+    head = np.append(filled, len(buf))[np.searchsorted(filled, starts)]
+    head = np.minimum(head, len(buf) - 1)
+    second = buf[np.minimum(head + 1, len(buf) - 1)]
+    blank = (head + 1 < starts + lengths) & ((second == ord(' ')) | (second == ord('\t')))
+    first = buf[head]
+    is_v = (first == ord('v')) & blank
+    is_f = (first == ord('f')) & blank
+    # сколько вершин объявлено до каждой грани, нужно для отрицательных индексов
+    v_before = np.cumsum(is_v)[is_f]
+
+    # все координаты вершин одним вызовом
+    text = _records(buf, lengths, head, is_v)
+    values = np.fromstring(text, sep=' ')
+    counts = _count_words(text, int(is_v.sum()))
+    if values.size != counts.sum() or np.any(counts < 3):
+        raise ValueError('не удалось разобрать координаты вершин')
+    # лишние значения (w, цвет вершины) отбрасываем
+    vertices = values[(np.cumsum(counts) - counts)[:, np.newaxis] + np.arange(3)]
+
+    nf = len(v_before)
+    if nf == 0:
+        tris = np.zeros((0, 3), dtype=np.int32)
+        return (vertices, tris, np.zeros(0, dtype=np.int64)) if relative else (vertices, tris)
+
+    # индексы вершин и количество вершин в каждой грани
+    idx, counts = _face_indices(_records(buf, lengths, head, is_f), nf)
+
+    # индексы в obj начинаются с единицы, отрицательные отсчитываются от последней объявленной вершины
+    negative = idx < 0
+    idx = np.where(negative, idx + np.repeat(v_before, counts), idx - 1)
+
+    # многоугольники разбиваем веером: (0, 1, 2), (0, 2, 3), (0, 3, 4) ...
+    ntri = np.maximum(counts - 2, 0)
+    offset = np.repeat(np.cumsum(counts) - counts, ntri)
+    k = np.arange(ntri.sum()) - np.repeat(np.cumsum(ntri) - ntri, ntri) + 1
+    corners = np.stack([offset, offset + k, offset + k + 1], axis=1)
+    tris = idx[corners].astype(np.int32)
+
+    if relative:
+        return vertices, tris, np.flatnonzero(negative[corners])
+    return vertices, tris
+
+
+# разобрать obj файл по частям в нескольких процессах
+def parse_obj_parallel(filename, workers=None, chunk_size=16 << 20):
+    """
+    Файл делится на куски по границам строк, каждый кусок разбирается в отдельном процессе,
+    в памяти процесса одновременно находится не больше одного куска текста
+    :param filename: obj файл
+    :param workers: количество процессов, по-умолчанию по количеству ядер
+    :param chunk_size: максимальный размер куска в байтах
+    :return: вершины np.array (N, 3) и треугольники np.array (F, 3) с индексами от нуля
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    # чтобы нагрузить все процессы, кусков должно быть не меньше, чем процессов
+    size = os.path.getsize(filename)
+    chunk_size = max(1, min(chunk_size, -(-size // workers)))
+    tasks = [(filename, start, end) for start, end in _line_ranges(filename, size, chunk_size)]
+
+    if workers == 1 or len(tasks) == 1:
+        parts = [_parse_obj_range(task) for task in tasks]
+    else:
+        # multiprocessing импортируем только здесь, он заметно замедляет импорт модуля
+        import multiprocessing
+
+        with multiprocessing.Pool(min(workers, len(tasks))) as pool:
+            parts = pool.map(_parse_obj_range, tasks, chunksize=1)
+
+    # положительные индексы в obj уже сквозные, а отрицательные отсчитаны от начала своего куска
+    v_offset = 0
+    for vertices, tris, rel in parts:
+        tris.ravel()[rel] += v_offset
+        v_offset += len(vertices)
+
+    vertices = np.concatenate([part[0] for part in parts])
+    tris = np.concatenate([part[1] for part in parts])
+    return vertices, tris
+
+
+# разбить файл на куски примерно по chunk_size байт, каждый кусок начинается с новой строки
+def _line_ranges(filename, size, chunk_size):
+    bounds = [0]
+    with open(filename, 'rb') as f:
+        while bounds[-1] + chunk_size < size:
+            # дочитываем строку, на которую попала граница куска
+            f.seek(bounds[-1] + chunk_size)
+            f.readline()
+            if f.tell() >= size:
+                break
+            bounds.append(f.tell())
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+# разобрать кусок obj файла с байта start по end, выполняется в процессе-помощнике
+def _parse_obj_range(task):
+    filename, start, end = task
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return parse_obj(data, relative=True)
+
+
+# пробельные символы
+def _spaces(buf):
+    return (buf == ord(' ')) | (buf == ord('\t')) | (buf == ord('\r')) | (buf == ord('\n'))
+
+
+# склеить выбранные строки без типа записи ("v ", "f "), который начинается с head, по строке на запись
+def _records(buf, lengths, head, lines):
+    keep = np.repeat(lines, lengths)
+    keep[head[lines]] = False
+    keep[head[lines] + 1] = False
+    return buf[keep].tobytes()
+
+
+# индексы вершин граней и количество слов в каждой из n строк
+# лишние индексы (текстур, нормалей) отбрасываются: 1/2/3 -> 1, 1//3 -> 1
+def _face_indices(text, n):
+    buf = np.frombuffer(text, dtype=np.uint8)
+    space = _spaces(buf)
+    # начало каждого слова
+    word = ~space
+    word[1:] &= space[:-1]
+    starts = np.flatnonzero(word)
+
+    # знак минус перед индексом
+    negative = buf[starts] == ord('-')
+    starts += negative
+    # конец числа - последняя цифра, после которой идет не цифра
+    digit = (buf >= ord('0')) & (buf <= ord('9'))
+    last = digit.copy()
+    last[:-1] &= ~digit[1:]
+    ends = np.flatnonzero(last)
+    lengths = ends[np.minimum(np.searchsorted(ends, starts), len(ends) - 1)] - starts + 1
+    # после числа должен идти пробел, '/' или конец текста
+    after = np.append(space | (buf == ord('/')), True)[starts + np.maximum(lengths, 0)]
+    if len(starts) and (np.any(lengths <= 0) or not digit[starts].all() or not after.all()):
+        raise ValueError('не удалось разобрать индексы граней')
+
+    # собираем числа из цифр, по одному разряду за проход
+    values = np.zeros(len(starts), dtype=np.int64)
+    for k in range(int(lengths.max(initial=0))):
+        m = lengths > k
+        values[m] = values[m] * 10 + (buf[starts[m] + k] - ord('0'))
+    values[negative] *= -1
+
+    return values, _count_lines(buf, word, n)
+
+
+# количество слов в каждой из n строк текста (bytes)
+def _count_words(text, n):
+    buf = np.frombuffer(text, dtype=np.uint8)
+    space = _spaces(buf)
+    # слово начинается с непробельного символа, перед которым пробел или начало текста
+    word = ~space
+    word[1:] &= space[:-1]
+    return _count_lines(buf, word, n)
+
+
+# сколько отмеченных символов в каждой из n строк
+def _count_lines(buf, marks, n):
+    ends = np.flatnonzero(buf == ord('\n'))[:n]
+    ends = np.concatenate((ends, [len(buf)] * (n - len(ends))))
+    return np.diff(np.searchsorted(np.flatnonzero(marks), ends), prepend=0)
+
+
+# двоичный формат модели: заголовок MESH_HEADER, затем вершины float32 (N, 3) и треугольники int32 (F, 3)
+MESH_EXT = '.mesh'
+MESH_MAGIC = b'DRAW3D\x00\x01'
+MESH_HEADER = np.dtype([
+    ('magic', 'S8'),
+    # количество вершин и треугольников
+    ('nv', '<u8'),
+    ('nf', '<u8'),
+    # время изменения, размер и sha256 исходного obj файла, чтобы заметить устаревшую копию
+    ('mtime', '<f8'),
+    ('size', '<u8'),
+    ('hash', 'S32'),
+])
+
+
+# sha256 содержимого файла
+def file_hash(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.digest()
+
+
+# перевести obj файл в двоичный формат, по-умолчанию рядом с ним: teddy.obj -> teddy.mesh
+def convert_obj(obj_filename, mesh_filename=None, workers=1):
+    if mesh_filename is None:
+        mesh_filename = os.path.splitext(obj_filename)[0] + MESH_EXT
+
+    # параметры файла берем до чтения, чтобы изменение во время чтения сделало копию устаревшей
+    stat = os.stat(obj_filename)
+    if workers == 1:
+        with open(obj_filename, 'rb') as f:
+            data = f.read()
+        vertices, tris = parse_obj(data)
+        digest = hashlib.sha256(data).digest()
+    else:
+        vertices, tris = parse_obj_parallel(obj_filename, workers)
+        digest = file_hash(obj_filename)
+
+    write_meshes(mesh_filename, [(vertices, tris)], stat, digest)
+    return mesh_filename
+
+
+# записать несколько сеток подряд, в заголовке каждой параметры исходного файла
+def write_meshes(filename, meshes, stat, digest):
+    """
+    :param meshes: список (vertices (N, 3), tris (F, 3))
+    :param stat: os.stat исходного файла
+    :param digest: sha256 исходного файла
+    """
+    # пишем во временный файл и подменяем, чтобы никто не открыл недописанную модель
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        for vertices, tris in meshes:
+            header = np.zeros(1, dtype=MESH_HEADER)
+            header['magic'] = MESH_MAGIC
+            header['nv'] = len(vertices)
+            header['nf'] = len(tris)
+            header['mtime'] = stat.st_mtime
+            header['size'] = stat.st_size
+            header['hash'] = digest
+            header.tofile(f)
+            np.asarray(vertices).astype('<f4').tofile(f)
+            np.asarray(tris).astype('<i4').tofile(f)
+    os.replace(tmp, filename)
+
+
+# заголовок двоичного файла модели, None если это не файл модели
+def read_mesh_header(filename):
+    header = np.fromfile(filename, dtype=MESH_HEADER, count=1)
+    if len(header) == 0 or header[0]['magic'] != MESH_MAGIC:
+        return None
+    return header[0]
+
+
+# открыть двоичный файл модели, массивы отображаются в память только для чтения
+def load_mesh(filename):
+    return load_meshes(filename)[0]
+
+
+# открыть все сетки, записанные в файл подряд
+def load_meshes(filename):
+    meshes = []
+    offset = 0
+    size = os.path.getsize(filename)
+    while offset < size or not meshes:
+        header = np.fromfile(filename, dtype=MESH_HEADER, count=1, offset=offset)
+        if len(header) == 0 or header[0]['magic'] != MESH_MAGIC:
+            raise ValueError(f'{filename} не является файлом модели')
+
+        nv, nf = int(header[0]['nv']), int(header[0]['nf'])
+        offset += MESH_HEADER.itemsize
+        vertices = np.memmap(filename, dtype='<f4', mode='r', offset=offset, shape=(nv, 3)) if nv else np.zeros((0, 3), dtype=np.float32)
+        offset += nv * 3 * 4
+        tris = np.memmap(filename, dtype='<i4', mode='r', offset=offset, shape=(nf, 3)) if nf else np.zeros((0, 3), dtype=np.int32)
+        offset += nf * 3 * 4
+        meshes.append((vertices, tris))
+    return meshes
+
+
+# актуальна ли двоичная копия obj файла
+def mesh_is_fresh(mesh_filename, obj_filename):
+    if not os.path.exists(mesh_filename):
+        return False
+    header = read_mesh_header(mesh_filename)
+    if header is None:
+        return False
+
+    stat = os.stat(obj_filename)
+    if stat.st_size != header['size']:
+        return False
+    if stat.st_mtime == header['mtime']:
+        return True
+
+    # время изменения другое, но содержимое могло остаться прежним
+    if file_hash(obj_filename) != header['hash']:
+        return False
+    # запоминаем новое время, чтобы в следующий раз не считать хэш
+    header['mtime'] = stat.st_mtime
+    with open(mesh_filename, 'r+b') as f:
+        np.array([header], dtype=MESH_HEADER).tofile(f)
+    return True
+
+
+# имя актуальной двоичной копии obj файла, при необходимости копия создается заново
+def cached_mesh(obj_filename, workers=1):
+    mesh_filename = os.path.splitext(obj_filename)[0] + MESH_EXT
+    if not mesh_is_fresh(mesh_filename, obj_filename):
+        convert_obj(obj_filename, mesh_filename, workers)
+    return mesh_filename
+
+
+# упрощенные копии модели из файла рядом с ней, при необходимости копии строятся заново
+# teddy.obj -> teddy.lod3.mesh, в файле подряд записаны заголовок и массивы каждого уровня
+def cached_lod(filename, levels, vertices, faces, ratio=0.25, min_faces=32):
+    """
+    :param filename: исходный файл модели, по нему проверяется актуальность копий
+    :param levels: количество уровней
+    :param vertices: вершины модели (N, 3)
+    :param faces: треугольники модели (F, 3)
+    :return: список (vertices, faces, None), массивы отображены в память
+    """
+    lod_filename = os.path.splitext(filename)[0] + f'.lod{levels}' + MESH_EXT
+    if not mesh_is_fresh(lod_filename, filename):
+        stat = os.stat(filename)
+        targets = [int(len(faces) * ratio ** (i + 1)) for i in range(levels)]
+        meshes = simplify_mesh(vertices, faces, [t for t in targets if t >= min_faces])
+        write_meshes(lod_filename, [(v, f) for v, f, c in meshes], stat, file_hash(filename))
+
+    return [(v, f, None) for v, f in load_meshes(lod_filename)]
+
+
+# оптимизация сетки после загрузки: склеить совпадающие вершины, выбросить лишнее
+# и переставить грани и вершины так, чтобы соседние грани брали вершины из соседних участков памяти
+def optimize_mesh(vertices, faces, colors=None, tolerance=1e-6):
+    """
+    :param vertices: np.array вершин формы (N, 3)
+    :param faces: np.array треугольников формы (F, 3)
+    :param colors: цвета треугольников формы (F, 3), None - без цветов
+    :param tolerance: вершины ближе этого расстояния склеиваются (и цепочки таких вершин тоже),
+                      0 - только точные совпадения
+    :return: vertices, faces, colors и словарь с количеством вершин и граней до и после
+    """
+    V = np.asarray(vertices, dtype=np.float64).reshape(-1, 3)
+    F = np.asarray(faces).reshape(-1, 3).astype(np.int64)
+    C = None if colors is None else np.asarray(colors).reshape(-1, 3)
+    stats = {'vertices_before': len(V), 'faces_before': len(F)}
+
+    # сначала склеиваем точные совпадения, каждая группа заменяется первой вершиной
+    points, first, weld = np.unique(V, axis=0, return_index=True, return_inverse=True)
+    weld = weld.ravel()
+    if tolerance > 0 and len(points):
+        # затем близкие: номер группы - наименьший номер среди вершин, соединенных парами ближе tolerance
+        weld = _weld_groups(points, tolerance)[weld]
+    F = first[weld][F]
+
+    # вырожденные грани: после склеивания две вершины совпали, или все три лежат на одной прямой
+    cross = np.cross(V[F[:, 1]] - V[F[:, 0]], V[F[:, 2]] - V[F[:, 0]])
+    keep = (F[:, 0] != F[:, 1]) & (F[:, 1] != F[:, 2]) & (F[:, 2] != F[:, 0]) & cross.any(1)
+    stats['degenerate'] = int((~keep).sum())
+
+    # одинаковые грани: тройка сдвигается по кругу так, чтобы первым шел наименьший индекс,
+    # направление обхода сохраняется, поэтому две стороны одной грани не склеиваются
+    shift = F.argmin(1)
+    rolled = np.take_along_axis(F, (shift[:, np.newaxis] + np.arange(3)) % 3, axis=1)
+    _, unique = np.unique(rolled[keep], axis=0, return_index=True)
+    ids = np.flatnonzero(keep)[np.sort(unique)]
+    stats['duplicate'] = int(keep.sum()) - len(ids)
+
+    # грани упорядочиваются вдоль кривой Мортона по центрам,
+    # затем вершины нумеруются в порядке первого появления в гранях, неиспользуемые вершины выпадают
+    order = ids[np.argsort(_morton(V[F[ids]].mean(1)), kind='stable')] if len(ids) else ids
+    F = F[order]
+    used, position, remap = np.unique(F.ravel(), return_index=True, return_inverse=True)
+    by_first = np.argsort(position, kind='stable')
+    rank = np.empty_like(by_first)
+    rank[by_first] = np.arange(len(by_first))
+    F = rank[remap.ravel()].reshape(-1, 3)
+    V = V[used[by_first]]
+    if C is not None:
+        C = C[order]
+
+    stats['vertices_after'] = len(V)
+    stats['faces_after'] = len(F)
+    return V, F.astype(np.int32), C, stats
+
+
+# группы близких точек: пространственный хэш с ячейками в несколько tolerance,
+# пары ищутся в ячейке точки и в тех соседних, до границы с которыми у точки меньше tolerance,
+# так что пары через границу ячейки не теряются
+def _weld_groups(points, tolerance, cell=4):
+    """
+    :param points: различные точки (N, 3)
+    :param tolerance: точки ближе этого расстояния попадают в одну группу
+    :param cell: размер ячейки в tolerance
+    :return: для каждой точки наименьший номер точки ее группы
+    """
+    n = len(points)
+    scaled = points / (tolerance * cell)
+    cells = np.floor(scaled).astype(np.int64)
+    # положение точки внутри ячейки, от 0 до cell
+    inside = (scaled - cells) * cell
+
+    # хэш ячейки, разные ячейки могут совпасть по хэшу, лишние пары отсеет проверка расстояния
+    def cell_hash(c):
+        return (c[..., 0] * 73856093) ^ (c[..., 1] * 19349663) ^ (c[..., 2] * 83492791)
+
+    keys = cell_hash(cells)
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+
+    a, b = [], []
+    for offset in itertools.product((-1, 0, 1), repeat=3):
+        offset = np.array(offset)
+        # в соседнюю ячейку смотрят только точки, которые ближе tolerance к общей с ней границе
+        near = np.ones(n, dtype=bool)
+        for axis in range(3):
+            if offset[axis] < 0:
+                near &= inside[:, axis] < 1
+            elif offset[axis] > 0:
+                near &= inside[:, axis] > cell - 1
+        ids = np.flatnonzero(near)
+        key = cell_hash(cells[ids] + offset)
+        lo, hi = np.searchsorted(keys, key, 'left'), np.searchsorted(keys, key, 'right')
+        count = hi - lo
+        i = np.repeat(ids, count)
+        j = order[np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count) + np.repeat(lo, count)]
+        close = (i < j) & (((points[i] - points[j]) ** 2).sum(1) <= tolerance ** 2)
+        a.append(i[close])
+        b.append(j[close])
+    a = np.concatenate(a)
+    b = np.concatenate(b)
+
+    # связные компоненты: у каждой пары берем меньший номер, потом сжимаем цепочки ссылок
+    groups = np.arange(n)
+    while True:
+        low = np.minimum(groups[a], groups[b])
+        before = groups.copy()
+        np.minimum.at(groups, a, low)
+        np.minimum.at(groups, b, low)
+        while True:
+            jumped = groups[groups]
+            if np.array_equal(jumped, groups):
+                break
+            groups = jumped
+        if np.array_equal(before, groups):
+            return groups
+
+
+# код Мортона точек: 10 бит каждой координаты внутри описанного параллелепипеда, чередуются по битам
+def _morton(points):
+    lo = points.min(0)
+    size = np.maximum(points.max(0) - lo, 1e-300)
+    q = ((points - lo) / size * 1023).astype(np.int64)
+    # раздвигаем 10 бит так, чтобы между ними было по два нулевых
+    q = (q | (q << 16)) & 0x030000FF
+    q = (q | (q << 8)) & 0x0300F00F
+    q = (q | (q << 4)) & 0x030C30C3
+    q = (q | (q << 2)) & 0x09249249
+    return (q[:, 0] << 2) | (q[:, 1] << 1) | q[:, 2]
+
+
+# упрощение сетки схлопыванием ребер по квадратичной ошибке (Garland, Heckbert),
+# за один проход схлопывается сразу много ребер, у которых нет общих вершин
+def simplify_mesh(vertices, faces, targets, colors=None):
+    """
+    :param vertices: np.array вершин формы (N, 3)
+    :param faces: np.array треугольников формы (F, 3)
+    :param targets: до скольких треугольников упрощать, по убыванию, для каждого получается своя сетка
+    :param colors: цвета треугольников формы (F, 3), None - без цветов
+    :return: список (vertices, faces, colors) по одному на каждое значение targets
+    """
+    V = np.array(vertices, dtype=np.float64).reshape(-1, 3)
+    F = np.array(faces, dtype=np.int64).reshape(-1, 3)
+    C = None if colors is None else np.asarray(colors).reshape(-1, 3)[:len(F)]
+    n = len(V)
+
+    # квадрика вершины - сумма квадратов расстояний до плоскостей соседних граней,
+    # при схлопывании ребра квадрики его вершин складываются
+    normals = np.cross(V[F[:, 1]] - V[F[:, 0]], V[F[:, 2]] - V[F[:, 0]])
+    area = np.sqrt((normals ** 2).sum(1))
+    ok = area > 0
+    planes = np.zeros((len(F), 4))
+    planes[ok, :3] = normals[ok] / area[ok, np.newaxis]
+    planes[:, 3] = -(planes[:, :3] * V[F[:, 0]]).sum(1)
+    # плоскость весит пропорционально площади грани
+    K = (planes[:, :, np.newaxis] * planes[:, np.newaxis, :] * area[:, np.newaxis, np.newaxis]).reshape(-1, 16)
+    Q = np.stack([np.bincount(F.ravel(), np.repeat(K[:, i], 3), n) for i in range(16)], axis=1).reshape(-1, 4, 4)
+
+    # ребра, схлопывание которых переворачивает грани, больше не пробуем
+    blocked = np.zeros(0, dtype=np.int64)
+    result = []
+    for target in targets:
+        while len(F) > target:
+            edges, boundary = _mesh_edges(F, n)
+            cost, pos = _collapse_cost(Q, V, edges)
+            # края открытых сеток не трогаем, иначе сетка стягивается
+            cost[boundary[edges].any(1)] = inf
+            cost[np.isin(edges[:, 0] * n + edges[:, 1], blocked)] = inf
+
+            while True:
+                chosen = _independent_edges(edges, cost, n, (len(F) - target + 1) // 2)
+                if len(chosen) == 0:
+                    break
+                a, b = edges[chosen].T
+                remap = np.arange(n)
+                remap[b] = a
+                moved = V.copy()
+                moved[a] = pos[chosen]
+
+                # грани, которые после схлопывания развернулись в обратную сторону
+                F2 = remap[F]
+                alive = (F2[:, 0] != F2[:, 1]) & (F2[:, 1] != F2[:, 2]) & (F2[:, 0] != F2[:, 2])
+                after = np.cross(moved[F2[:, 1]] - moved[F2[:, 0]], moved[F2[:, 2]] - moved[F2[:, 0]])
+                flipped = alive & ((normals * after).sum(1) <= 0) & ok
+                if not flipped.any():
+                    break
+                # отменяем схлопывания, которые задели такие грани
+                touched = np.zeros(n, dtype=bool)
+                touched[F2[flipped]] = True
+                bad = chosen[touched[edges[chosen, 0]]]
+                blocked = np.concatenate([blocked, edges[bad, 0] * n + edges[bad, 1]])
+                cost[bad] = inf
+
+            if len(chosen) == 0:
+                break
+            V = moved
+            Q[a] += Q[b]
+            F, normals, ok = F2[alive], after[alive], ok[alive]
+            if C is not None:
+                C = C[alive]
+
+        # выбрасываем неиспользуемые вершины
+        used, inverse = np.unique(F, return_inverse=True)
+        result.append((V[used], inverse.reshape(-1, 3).astype(np.int32), C))
+    return result
+
+
+# уникальные ребра сетки (E, 2) с меньшим индексом первым и маска вершин на краях открытой сетки
+def _mesh_edges(F, n):
+    pairs = np.sort(np.concatenate([F[:, [0, 1]], F[:, [1, 2]], F[:, [2, 0]]]), axis=1)
+    keys, counts = np.unique(pairs[:, 0] * n + pairs[:, 1], return_counts=True)
+    edges = np.stack([keys // n, keys % n], axis=1)
+    # ребро, у которого только одна грань, лежит на краю
+    boundary = np.zeros(n, dtype=bool)
+    boundary[edges[counts == 1].ravel()] = True
+    return edges, boundary
+
+
+# ошибка схлопывания каждого ребра и лучшее положение получившейся вершины
+def _collapse_cost(Q, V, edges):
+    Qe = Q[edges[:, 0]] + Q[edges[:, 1]]
+    a, b = V[edges[:, 0]], V[edges[:, 1]]
+    candidates = [a, b, (a + b) / 2]
+
+    # точка минимума квадрики, если система уравнений не вырождена
+    A = Qe[:, :3, :3]
+    solvable = np.abs(np.linalg.det(A)) > 1e-12
+    best = (a + b) / 2
+    if solvable.any():
+        best[solvable] = np.linalg.solve(A[solvable], -Qe[solvable, :3, 3:])[..., 0]
+    # слишком далекий минимум - признак плохо обусловленной системы
+    far = ((best - (a + b) / 2) ** 2).sum(1) > ((a - b) ** 2).sum(1)
+    best[far] = ((a + b) / 2)[far]
+    candidates.append(best)
+
+    cost = np.full(len(edges), inf)
+    pos = np.empty((len(edges), 3))
+    for p in candidates:
+        h = np.concatenate([p, np.ones((len(p), 1))], axis=1)
+        c = np.einsum('ei,eij,ej->e', h, Qe, h)
+        better = c < cost
+        cost[better] = c[better]
+        pos[better] = p[better]
+    return cost, pos
+
+
+# ребра с наименьшей ошибкой среди всех ребер своих вершин, такие ребра не имеют общих вершин
+def _independent_edges(edges, cost, n, limit):
+    order = np.argsort(cost, kind='stable')
+    order = order[cost[order] < inf]
+    rank = np.empty(len(edges), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+
+    # наименьший ранг ребра у каждой вершины
+    best = np.full(n, len(edges), dtype=np.int64)
+    np.minimum.at(best, edges[order, 0], rank[order])
+    np.minimum.at(best, edges[order, 1], rank[order])
+    chosen = order[(best[edges[order, 0]] == rank[order]) & (best[edges[order, 1]] == rank[order])]
+    return chosen[:max(limit, 1)]
+
+
 # вычисление нормали по трем точкам
 def normal_calc(pts):
     # находим вектора двух граней треугольника
     A = pts[:, 1]-pts[:, 0]
     B = pts[:, 2]-pts[:, 0]
     cross = np.cross(A, B)
-    # нормализуем, чтобы получить единичный вектор
+    # нормализуем, чтобы получить единичные вектора
     # https://stackoverflow.com/questions/2850743/numpy-how-to-quickly-normalize-many-vectors
     return cross / np.sqrt((cross ** 2).sum(-1))[..., np.newaxis]
 
 
-# возвращаем центроид всех Z-координат для списка точек
+# единичные нормали граней сетки в пространстве модели, у вырожденных граней - nan
+def mesh_normals(V, faces):
+    """
+    :param V: вершины (3, N)
+    :param faces: треугольники (F, 3)
+    :return: нормали (F, 3)
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return normal_calc(np.take(V.T, faces, axis=0))
+
+
+# повернуть единичные нормали граней матрицей преобразования точек
+def transform_normals(normals, A):
+    """
+    :param normals: нормали (F, 3) в пространстве модели
+    :param A: левая верхняя часть 3x3 матрицы преобразования (точки умножаются на нее справа)
+    :return: единичные нормали (F, 3), направленные так же, как посчитанные normal_calc по преобразованным точкам,
+             None - матрица вырождена
+    """
+    # матрица 3x3 разбирается на обычных числах python: вызовы numpy для нее дороже самих вычислений
+    (a00, a01, a02), (a10, a11, a12), (a20, a21, a22) = A.tolist()
+    # строки матрицы алгебраических дополнений C = det(A) * inv(A).T
+    c0 = a11 * a22 - a12 * a21, a12 * a20 - a10 * a22, a10 * a21 - a11 * a20
+    det = a00 * c0[0] + a01 * c0[1] + a02 * c0[2]
+    if det == 0:
+        return None
+    # без неравномерного масштаба строки A ортогональны и одной длины, A - поворот, умноженный на число:
+    # достаточно поделить на это число, знак определителя сохраняет направление нормали у зеркальных преобразований
+    s2 = a00 * a00 + a01 * a01 + a02 * a02
+    eps = 1e-7 * s2
+    if (fabs(a10 * a10 + a11 * a11 + a12 * a12 - s2) <= eps and fabs(a20 * a20 + a21 * a21 + a22 * a22 - s2) <= eps
+            and fabs(a00 * a10 + a01 * a11 + a02 * a12) <= eps and fabs(a00 * a20 + a01 * a21 + a02 * a22) <= eps
+            and fabs(a10 * a20 + a11 * a21 + a12 * a22) <= eps):
+        return normals @ (A * (copysign(1.0, det) / sqrt(s2))).astype(normals.dtype, copy=False)
+    # иначе нормали умножаются на обратную транспонированную матрицу (с точностью до det) и нормализуются заново
+    C = np.array([c0,
+                  (a21 * a02 - a22 * a01, a22 * a00 - a20 * a02, a20 * a01 - a21 * a00),
+                  (a01 * a12 - a02 * a11, a02 * a10 - a00 * a12, a00 * a11 - a01 * a10)], dtype=normals.dtype)
+    normals = normals @ C
+    return normals / np.sqrt((normals ** 2).sum(-1))[..., np.newaxis]
+
+
+# возвращаем центроид Z-координат для каждого треугольника в массиве (N, 3, 3)
 def zorder(p):
-    return (p[0][2] + p[1][2] + p[2][2])/3
+    return (p[:, 0, 2] + p[:, 1, 2] + p[:, 2, 2])/3
+
+
+# иерархия ограничивающих сфер (BVH) над объектами сцены,
+# позволяет отбросить целую группу объектов за экраном одной проверкой
+class BVH:
+    # не больше стольких объектов в листе
+    leaf_size = 4
+
+    def __init__(self, objects):
+        self.objects = list(objects)
+        # по этим ключам видно, что объекты сцены или их преобразования изменились
+        self.keys = [obj.world_version for obj in self.objects]
+
+        bounds = [obj.bounds() for obj in self.objects]
+        self.positions = np.array([b[0] for b in bounds]).reshape(-1, 3)
+        self.reach = np.array([b[1] for b in bounds])
+        self.scale = np.array([b[2] for b in bounds])
+
+        # объекты без размеров видны всегда и в дерево не попадают
+        self.unbounded = [i for i, r in enumerate(self.reach) if r == inf]
+        bounded = [i for i, r in enumerate(self.reach) if r != inf]
+        # лист, в котором лежит каждый объект
+        self.leaves = {}
+        self.root = self._build(bounded, None, 0) if bounded else None
+
+    def _build(self, ids, parent, depth):
+        """
+        Узел дерева: сфера вокруг точки center радиусом dist + reach * |поворот/масштаб вида| + scale * |смещение вида|,
+        в которую помещаются все объекты поддерева
+        :return: [center, dist, reach, scale, номера всех объектов поддерева, дочерние узлы или None для листа,
+                  родитель, глубина]
+        """
+        positions = self.positions[ids]
+        low, high = positions.min(0), positions.max(0)
+        center = (low + high) / 2
+        dist = sqrt(((positions - center) ** 2).sum(1).max())
+        node = [center, dist, self.reach[ids].max(), self.scale[ids].max(), ids, None, parent, depth]
+
+        if len(ids) <= self.leaf_size:
+            for i in ids:
+                self.leaves[i] = node
+            return node
+
+        # делим пополам по оси, вдоль которой объекты разбросаны сильнее всего
+        axis = np.argmax(high - low)
+        ids = [ids[i] for i in np.argsort(positions[:, axis], kind='stable')]
+        half = len(ids) // 2
+        node[5] = self._build(ids[:half], node, depth + 1), self._build(ids[half:], node, depth + 1)
+        return node
+
+    def refit(self, keys):
+        """
+        Обновить дерево после перемещения объектов без перестройки: пересчитываются границы только сдвинувшихся
+        объектов и сферы узлов над ними, от листьев к корню
+        :param keys: новые world_version тех же объектов в том же порядке
+        :return: False, если так обновить нельзя и дерево нужно построить заново
+        """
+        changed = [i for i, (old, new) in enumerate(zip(self.keys, keys)) if old != new]
+        for i in changed:
+            position, reach, scale = self.objects[i].bounds()
+            # объект стал бесконечным или перестал им быть
+            if (reach == inf) != (self.reach[i] == inf):
+                return False
+            self.positions[i], self.reach[i], self.scale[i] = position, reach, scale
+        self.keys = keys
+
+        # узлы над сдвинувшимися объектами, каждый один раз; глубокие раньше, чтобы родитель видел новые сферы детей
+        dirty = {}
+        for i in changed:
+            node = self.leaves.get(i)
+            while node is not None and id(node) not in dirty:
+                dirty[id(node)] = node
+                node = node[6]
+        for node in sorted(dirty.values(), key=lambda n: -n[7]):
+            if node[5] is None:
+                positions = self.positions[node[4]]
+                node[0] = (positions.min(0) + positions.max(0)) / 2
+                node[1] = sqrt(((positions - node[0]) ** 2).sum(1).max())
+                node[2], node[3] = self.reach[node[4]].max(), self.scale[node[4]].max()
+            else:
+                # сфера, в которую помещаются сферы обоих детей
+                a, b = node[5]
+                node[0], node[1] = _enclose(a[0], a[1], b[0], b[1])
+                node[2], node[3] = max(a[2], b[2]), max(a[3], b[3])
+        return True
+
+    # объекты, которые хотя бы частично попадают в видимую область view, в исходном порядке
+    def visible(self, view):
+        M = view.transform.matrix
+        rot, shift = np.linalg.norm(M[:3, :3], 2), sqrt((M[3, :3] ** 2).sum())
+
+        result = list(self.unbounded)
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            center, dist, reach, scale, ids, children = stack.pop()[:6]
+            inside = view.sphere_visibility(center, dist + reach * rot + scale * shift)
+            if inside < 0:
+                continue
+            if inside > 0:
+                result.extend(ids)
+            elif children is not None:
+                stack.extend(children)
+            else:
+                # в листе проверяем точные сферы объектов
+                result.extend(i for i in ids if view.sphere_visibility(*self.objects[i].sphere(view.transform)) >= 0)
+
+        return [self.objects[i] for i in sorted(result)]
+
+
+# наименьшая сфера, в которую помещаются две сферы
+def _enclose(c1, r1, c2, r2):
+    d = sqrt(((c2 - c1) ** 2).sum())
+    if d + r2 <= r1:
+        return c1, r1
+    if d + r1 <= r2:
+        return c2, r2
+    r = (d + r1 + r2) / 2
+    return c1 + (c2 - c1) * ((r - r1) / d), r
+
+
+# подготовленный кадр: все, что нужно передать рендеру, и замеры этапов подготовки
+class Frame:
+    def __init__(self):
+        # экранные координаты (N, 3, 2), глубина вершин (N, 3), цвета (N, 3) в порядке рисования,
+        # None - на сцене нет объектов
+        self.screen = None
+        self.depth = None
+        self.colors = None
+        # сколько треугольников было и сколько выбросила каждая проверка
+        self.stats = dict.fromkeys(('total', 'degenerate', 'backface', 'offscreen', 'subpixel', 'drawn'), 0)
+        # время этапов в секундах и количество треугольников на входе и выходе каждого этапа
+        self.times = {}
+        self.triangles = {}
+        self.start = self.last = time.perf_counter()
+
+    # этап stage закончен, на вход пришло tris_in треугольников, дальше идет tris_out
+    def mark(self, stage, tris_in, tris_out):
+        now = time.perf_counter()
+        self.times[stage] = now - self.last
+        self.triangles[stage] = tris_in, tris_out
+        self.last = now
+
+
+# замеры времени этапов Scene.draw за последние size кадров (кольцевой буфер)
+class FrameProfiler:
+    # этапы кадра в порядке выполнения
+    stages = ('gather', 'cull', 'project', 'shade', 'sort', 'render')
+
+    def __init__(self, size=300, overlay=False, color=(255, 255, 255), font=None):
+        """
+        :param size: сколько последних кадров хранить
+        :param overlay: выводить статистику поверх кадра через Render.draw_text
+        :param color: цвет текста статистики
+        :param font: шрифт текста статистики, None - шрифт по-умолчанию
+        """
+        self.size = size
+        self.overlay = overlay
+        self.color = color
+        self.font = font
+        # время каждого этапа в секундах и всего кадра (последний столбец)
+        self.times = np.zeros((size, len(self.stages) + 1))
+        # количество треугольников на входе и выходе каждого этапа
+        self.triangles = np.zeros((size, len(self.stages), 2), dtype=np.int64)
+        # вызовов отрисовки за кадр
+        self.draw_calls = np.zeros(size, dtype=np.int64)
+        # сколько кадров замерено всего
+        self.frames = 0
+
+    # записать замеры показанного кадра
+    def record(self, frame, draw_calls):
+        """
+        :param frame: Frame с замерами этапов
+        :param draw_calls: сколько вызовов отрисовки ушло на кадр
+        """
+        row = self.frames % self.size
+        self.times[row] = 0
+        self.triangles[row] = 0
+        for i, stage in enumerate(self.stages):
+            if stage in frame.times:
+                self.times[row, i] = frame.times[stage]
+                self.triangles[row, i] = frame.triangles[stage]
+        self.times[row, -1] = frame.last - frame.start
+        self.draw_calls[row] = draw_calls
+        self.frames += 1
+
+    def percentiles(self, stage=None, q=(50, 95, 99)):
+        """
+        Процентили времени этапа по кадрам в буфере, в секундах
+        :param stage: имя этапа, None - весь кадр
+        :return: {'p50': ..., 'p95': ..., 'p99': ...}
+        """
+        n = min(self.frames, self.size)
+        column = -1 if stage is None else self.stages.index(stage)
+        if n == 0:
+            return {f'p{p}': 0.0 for p in q}
+        return dict(zip((f'p{p}' for p in q), np.percentile(self.times[:n, column], q).tolist()))
+
+    # сводка по всем этапам: процентили времени и треугольники последнего кадра
+    def report(self):
+        last = (self.frames - 1) % self.size
+        result = {'frame': self.percentiles(), 'draw_calls': int(self.draw_calls[last]) if self.frames else 0}
+        for i, stage in enumerate(self.stages):
+            tris_in, tris_out = self.triangles[last, i].tolist() if self.frames else (0, 0)
+            result[stage] = dict(self.percentiles(stage), tris_in=tris_in, tris_out=tris_out)
+        return result
+
+    # строки для вывода поверх кадра
+    def lines(self):
+        report = self.report()
+        frame = report['frame']
+        lines = [f'frame  p50 {frame["p50"] * 1e3:6.1f}  p95 {frame["p95"] * 1e3:6.1f}  p99 {frame["p99"] * 1e3:6.1f} ms'
+                 f'  calls {report["draw_calls"]}']
+        for stage in self.stages:
+            r = report[stage]
+            lines.append(f'{stage:7} p50 {r["p50"] * 1e3:6.1f}  p95 {r["p95"] * 1e3:6.1f} ms  {r["tris_in"]} -> {r["tris_out"]}')
+        return lines
+
+    # вывести статистику поверх кадра
+    def draw_overlay(self, render, x=5, y=5, line_height=14):
+        for i, line in enumerate(self.lines()):
+            render.draw_text(x, y + i * line_height, line, self.color, self.font)
 
 
 # 3d сцена
 class Scene:
-    def __init__(self, view=None, render: Render=None, flat_shading=True, backface_cull=False):
+    def __init__(self, view=None, render: Render=None, flat_shading=True, backface_cull=False, frustum_cull=False,
+                 lod_detail=0.25, profiler=None, dtype=np.float64):
         """
         :param view: настройки камеры/зрителя
-        :param render: класс, который рисует
-        :param flat_shading: включить плоское закрашивание
+        :param render: класс который рисует
         :param backface_cull: отсечение невидимых граней
+        :param flat_shading: включить/выключить плоское закрашивание
+        :param frustum_cull: не обрабатывать объекты, которые целиком за пределами экрана или за камерой
+        :param lod_detail: для объектов с уровнями детализации - сколько треугольников нужно на квадратный пиксель,
+                           0 - всегда рисовать полную сетку
+        :param profiler: FrameProfiler для замеров времени этапов кадра, None - без замеров
+        :param dtype: точность геометрии: вершины, треугольники, нормали и проекция считаются в np.float32 или np.float64
         :param objects:
         """
         self.view = view
@@ -332,136 +2234,540 @@ class Scene:
         self.objects = []
         self.backface_cull = backface_cull
         self.flat_shading = flat_shading
-
+        self.frustum_cull = frustum_cull
+        self.lod_detail = lod_detail
+        self.profiler = profiler
+        self.dtype = dtype
+        # сколько треугольников было в последнем кадре и сколько выбросила каждая проверка
+        self.stats = Frame().stats
+        # последний нарисованный кадр
+        self.last_frame = None
+        # иерархия ограничивающих сфер, перестраивается при изменении объектов
+        self.bvh = None
+
+    # добавить объект вместе со всеми его потомками, в self.objects попадает только он сам
     def add_object(self, obj):
+        for node in obj.walk():
+            node.set_dtype(self.dtype)
         self.objects.append(obj)
 
+    # все объекты сцены вместе с потомками, родители раньше детей
+    def nodes(self):
+        return [node for obj in self.objects for node in obj.walk()]
+
+    # объекты, которые нужно рисовать
+    def visible_objects(self):
+        nodes = self.nodes()
+        if not self.frustum_cull:
+            return nodes
+
+        # дерево строится заново, только если изменился список объектов,
+        # после перемещения объектов в нем обновляются только сферы над ними
+        keys = [obj.world_version for obj in nodes]
+        if self.bvh is None or self.bvh.objects != nodes:
+            self.bvh = BVH(nodes)
+        elif self.bvh.keys != keys and not self.bvh.refit(keys):
+            self.bvh = BVH(nodes)
+        return self.bvh.visible(self.view)
+
     def draw(self):
-        self.render.clear_screen()
+        self.submit(self.prepare())
+
+    def prepare(self):
+        """
+        Подготовить кадр: вся работа numpy без обращений к рендеру, поэтому можно вызывать из другого потока
+        :return: Frame
+        """
+        frame = Frame()
+        stats = frame.stats
         # все треугольники сцены
         triangles = []
         # цвета треугольников
         colors = []
 
-        for obj in self.objects:
-            # геометрия
-            tris, cols = obj.get_geometry(transform=self.view.transform)
-            triangles.extend(tris)
-            colors.extend(cols)
-
-        triangles = np.array(triangles)
+        # нормали треугольников и маски вырожденных, если они нужны
+        normals = []
+        need_normals = self.flat_shading or self.backface_cull
+
+        for obj in self.visible_objects():
+            # потомок мог появиться в дереве после add_object, приводим его к точности сцены
+            # (если точность уже та, set_dtype ничего не делает)
+            obj.set_dtype(self.dtype)
+            # геометрия, издалека упрощенная
+            # (get_geometry своих объектов может не принимать уровень, поэтому 0 не передаем)
+            level = obj.select_lod(self.view, self.lod_detail) if self.lod_detail else 0
+            if level:
+                tris, cols = obj.get_geometry(self.view.transform, level)
+            else:
+                tris, cols = obj.get_geometry(transform=self.view.transform)
+            triangles.append(np.asarray(tris))
+            colors.append(np.asarray(cols).reshape(-1, 3))
+            if need_normals:
+                normals.append(obj.face_normals(self.view.transform, triangles[-1], level))
+
+        if not triangles:
+            return frame
+
+        # склеиваем геометрию всех объектов в массивы (N, 3, 3) и (N, 3)
+        triangles = np.concatenate(triangles)
+        colors = np.concatenate(colors)
+        frame.mark('gather', 0, len(triangles))
+
+        # ранний отбор: до сортировки и вывода выбрасываем треугольники, которые не дадут ни одного пикселя,
+        # каждая следующая проверка работает только с тем, что осталось после предыдущих
+        stats['total'] = len(triangles)
+        ids = np.arange(len(triangles))
+
+        if need_normals:
+            nz = np.concatenate([n[:, 2] for n, _ in normals])
+            # у вырожденных треугольников нормаль не определена, объекты с готовыми нормалями отмечают их заранее,
+            # у остальных они ищутся по nan
+            drop = np.concatenate([np.isnan(n[:, 2]) if degenerate is None else degenerate for n, degenerate in normals])
+            stats['degenerate'] = int(drop.sum())
+            # отсекаем невидимые грани, нормаль которых повернута от наблюдателя
+            if self.backface_cull:
+                back = nz > 0
+                stats['backface'] = int(back.sum())
+                drop |= back
+            ids = ids[~drop]
+        frame.mark('cull', len(triangles), len(ids))
+
+        # в экранные координаты переводим только оставшиеся треугольники, все за один вызов
+        screen = self.view.to_screen_batch(triangles[ids])
+        x = screen[..., 0]
+        y = screen[..., 1]
+
+        # целиком за одним из краев экрана или целиком за камерой
+        drop = (x.max(1) < 0) | (x.min(1) >= self.view.w) | (y.max(1) < 0) | (y.min(1) >= self.view.h)
+        if self.view.persp:
+            drop |= (triangles[ids, :, 2] >= self.view.offset).all(1)
+        stats['offscreen'] = int(drop.sum())
+
+        # на экране площадь нулевая - все три точки на одной прямой или в одном пикселе
+        area = (x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0]) - (x[:, 2] - x[:, 0]) * (y[:, 1] - y[:, 0])
+        small = (area == 0) & ~drop
+        stats['subpixel'] = int(small.sum())
+        keep = ~(drop | small)
+        ids, screen = ids[keep], screen[keep]
+        stats['drawn'] = len(ids)
+        frame.mark('project', len(keep), len(ids))
 
         # флаг плоского закрашивания включен
         if self.flat_shading:
-            # вычисляем нормали
-            #print(triangles.shape)
-            normals = normal_calc(triangles)
-
             # "для получения цвета грани нужно умножить каждую компоненту на абсолютное значение nz."
-            colors = [np.array(colors[i]) * fabs(normals[i][2]) for i in range(len(normals))]
-
-        def by_z(idx):
-            return zorder(triangles[idx])
-
-        # вместо самих треугольников сортируем их индексы
-        for i in sorted(range(len(triangles)), key=by_z):
-            # отсекаем невидимые грани, нормаль которых повернута от наблюдателя
-
-            if isnan(normals[i][2]):
-                continue
-
-            if self.backface_cull:
-                if normals[i][2] > 0:
-                    continue
-
-            # преобразуем треугольник к экранным координатам
-            p = self.view.to_screen(triangles[i])
-            
-            self.render.draw_tri(p[0], p[1], p[2], colors[i])
-
-            # рисуем красный wireframe, для отладки
-            # red = (255, 0, 0)
-            # self.render.draw_line(p[0], p[1], 1, red)
-            # self.render.draw_line(p[1], p[2], 1, red)
-            # self.render.draw_line(p[2], p[0], 1, red)
-
-w = 600
-h = 400
-v = View(w, h, d=200, persp=True)
-
-from tkinter import *
-
-# создаем объекты
-root = Tk()
-
-c = Canvas(root, width=w, height=h, bg='#00ff00')
-c.pack()
+            colors = colors[ids] * np.abs(nz[ids])[:, np.newaxis]
+        else:
+            colors = colors[ids]
+        frame.mark('shade', len(ids), len(ids))
 
+        if self.render.needs_sort:
+            # вместо самих треугольников сортируем их индексы,
+            # stable сохраняет исходный порядок треугольников с одинаковой глубиной
+            order = np.argsort(zorder(triangles[ids]), kind='stable')
+        else:
+            # рендер сам разбирается с перекрытием (z-буфер)
+            order = slice(None)
+        frame.screen = screen[order]
+        frame.depth = triangles[ids[order], :, 2]
+        frame.colors = colors[order]
+        frame.mark('sort', len(ids), len(ids))
+        return frame
+
+    # нарисовать подготовленный кадр, только из потока, которому принадлежит рендер (для Tk - главного)
+    def submit(self, frame: Frame):
+        self.last_frame = frame
+        self.stats = frame.stats
+        calls = self.render.draw_calls
+        # время ожидания между подготовкой и рисованием входит только во время всего кадра
+        frame.last = time.perf_counter()
 
+        self.render.clear_screen()
+        if frame.screen is not None:
+            self.render.draw_tris(frame.screen, frame.depth, frame.colors)
 
-scene = Scene(v, CanvasRender(c))
-model = Star(pos=[0,0,0])
-model.transform.teta = pi / 4
-model.transform.phi = pi / 4
-#cube = Cube(side=100, rot=[0.0, pi/5, 0], pos=[-400, -200, -100])
-scene.add_object(Quad(800, 800, -300, color=(255, 255, 255)))
-scene.add_object(model)
-#scene.add_object(cube)
-    
+        # статистика выводится поверх кадра, если она нужна
+        prof = self.profiler
+        if prof is not None and prof.overlay:
+            prof.draw_overlay(self.render)
+        self.render.present()
 
-def up():
-    model.transform.phi += 0.1
-    scene.draw()
+        tris = frame.stats['drawn']
+        frame.mark('render', tris, tris)
+        if prof is not None:
+            prof.record(frame, self.render.draw_calls - calls)
 
 
-# метод нажатия на кнопку ВНИЗ
-def down():
-    model.transform.phi -= 0.1
-    scene.draw()
-
+# подготовка кадров сцены в фоновом потоке, главный поток только рисует готовые кадры
+# пока рендер рисует кадр N, поток уже считает кадр N + 1
+class FrameWorker:
+    def __init__(self, scene: Scene, root=None, poll=5):
+        """
+        :param scene: сцена, ее рендер используется только из главного потока
+        :param root: окно Tk, через его after готовые кадры забираются автоматически,
+                     None - нужно самому вызывать poll()
+        :param poll: как часто проверять готовый кадр, мс
+        """
+        self.scene = scene
+        self.root = root
+        self.poll_ms = poll
+        # двойная буферизация: поток заполняет один кадр, пока готовый ждет в self.ready
+        self.ready = None
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        # сколько готовых кадров выброшено, потому что следующий поспел раньше, чем их нарисовали
+        self.dropped = 0
+        self.prepared = 0
+        self.running = False
+        self.error = None
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='draw3d-frames', daemon=True)
+        self.thread.start()
+        if self.root is not None:
+            self.root.after(self.poll_ms, self._poll)
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    # сцена изменилась, нужен новый кадр; вызовы, пришедшие пока кадр считается, склеиваются в один
+    def request(self):
+        self.wake.set()
+
+    def _run(self):
+        while True:
+            self.wake.wait()
+            self.wake.clear()
+            if not self.running:
+                return
+            try:
+                frame = self.scene.prepare()
+            except Exception as e:
+                # ошибку покажет главный поток в poll(), а поток продолжает ждать запросы:
+                # следующий кадр может получиться, если сцену исправят
+                self.error = e
+                continue
+            with self.lock:
+                # прошлый кадр так и не нарисован и уже устарел
+                if self.ready is not None:
+                    self.dropped += 1
+                self.ready = frame
+                self.prepared += 1
+
+    def poll(self):
+        """
+        Нарисовать готовый кадр, если он есть. Вызывать из главного потока
+        :return: True, если кадр нарисован
+        """
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+        with self.lock:
+            frame, self.ready = self.ready, None
+        if frame is None:
+            return False
+        self.scene.submit(frame)
+        return True
+
+    def _poll(self):
+        if not self.running:
+            return
+        # следующая проверка планируется заранее, чтобы ошибка кадра не остановила перерисовку окна
+        self.root.after(self.poll_ms, self._poll)
+        self.poll()
+
+
+# перерисовка с постоянной частотой: ввод только накапливает изменения Transform,
+# а сцена рисуется не чаще одного раза за интервал и только если что-то изменилось
+class FrameScheduler:
+    def __init__(self, scene: Scene, root, fps=60, worker: FrameWorker = None, history=120):
+        """
+        :param scene: сцена
+        :param root: окно Tk, тики идут через root.after
+        :param fps: желаемая частота кадров
+        :param worker: FrameWorker без root - кадры готовятся в фоновом потоке, None - scene.draw() в главном
+        :param history: по скольким последним кадрам считать статистику
+        """
+        self.scene = scene
+        self.root = root
+        self.interval = 1.0 / fps
+        self.worker = worker
+        # накопленные изменения: (transform, имя параметра) -> сколько прибавить
+        self.pending = {}
+        # нужно перерисовать, даже если изменений Transform нет
+        self.dirty = True
+        # моменты показа и длительность последних кадров
+        self.presented = deque(maxlen=history)
+        self.frame_times = deque(maxlen=history)
+        self.frames = 0
+        # тики, на которых рисовать было нечего
+        self.skipped = 0
+        self.running = False
+        self._next = 0.0
+
+    # изменить параметр name у transform на delta, изменение применится в ближайшем кадре
+    def add(self, transform: Transform, name, delta):
+        key = (transform, name)
+        self.pending[key] = self.pending.get(key, 0.0) + delta
+
+    # сцена изменилась как-то иначе, нужно перерисовать
+    def invalidate(self):
+        self.dirty = True
+
+    def start(self):
+        self.running = True
+        self._next = time.perf_counter()
+        self._tick()
+
+    def stop(self):
+        self.running = False
+
+    def tick(self):
+        """
+        Применить накопленный ввод и перерисовать, если что-то изменилось
+        :return: True, если кадр нарисован
+        """
+        changed = self.dirty or bool(self.pending)
+        if changed:
+            pending, self.pending = self.pending, {}
+            for (transform, name), delta in pending.items():
+                setattr(transform, name, getattr(transform, name) + delta)
+            self.dirty = False
+            if self.worker is None:
+                self.scene.draw()
+                self._presented()
+                return True
+            self.worker.request()
+
+        if self.worker is not None and self.worker.poll():
+            self._presented()
+            return True
+        if not changed:
+            self.skipped += 1
+        return False
+
+    def _presented(self):
+        self.frames += 1
+        self.presented.append(time.perf_counter())
+        frame = self.scene.last_frame
+        self.frame_times.append(frame.last - frame.start)
+
+    def _tick(self):
+        if not self.running:
+            return
+        try:
+            self.tick()
+        finally:
+            # следующий тик по расписанию, опоздавшие тики пропускаются, а не догоняются,
+            # ошибка кадра не останавливает перерисовку
+            now = time.perf_counter()
+            self._next = max(self._next + self.interval, now)
+            self.root.after(max(1, int((self._next - now) * 1000)), self._tick)
+
+    def stats(self):
+        """
+        :return: {'fps': достигнутая частота кадров, 'p50'/'p95'/'p99': время кадра в секундах,
+                  'frames': нарисовано кадров, 'skipped': пропущено тиков без изменений}
+        """
+        fps = 0.0
+        if len(self.presented) > 1 and self.presented[-1] > self.presented[0]:
+            fps = (len(self.presented) - 1) / (self.presented[-1] - self.presented[0])
+        times = np.percentile(self.frame_times, (50, 95, 99)).tolist() if self.frame_times else [0.0] * 3
+        return dict(fps=fps, p50=times[0], p95=times[1], p99=times[2], frames=self.frames, skipped=self.skipped)
+
+
+# кадры полного оборота камеры вокруг сцены
+def turntable(base, frames, axis='teta'):
+    """
+    :param base: исходное положение камеры (Transform)
+    :param frames: количество кадров на оборот
+    :param axis: угол, который меняется от кадра к кадру: phi, teta или psi
+    :return: список Transform, по одному на кадр
+    """
+    schedule = []
+    for i in range(frames):
+        t = Transform(*[getattr(base, name) for name in Transform.params])
+        setattr(t, axis, getattr(base, axis) + 2 * pi * i / frames)
+        schedule.append(t)
+    return schedule
+
+
+# отрисовать анимацию в файлы, кадры распределяются по процессам
+def render_animation(scene, schedule, output='frame_{:04d}.png', workers=None, bg=(0, 255, 0)):
+    """
+    Нарисовать все кадры анимации в нескольких процессах и записать их на диск, параметры - как у iter_animation
+    :return: список имен файлов по порядку кадров
+    """
+    return list(iter_animation(scene, schedule, output, workers, bg))
+
+
+# то же, что render_animation, но имена файлов выдаются по мере готовности кадров
+def iter_animation(scene, schedule, output='frame_{:04d}.png', workers=None, bg=(0, 255, 0)):
+    """
+    Каждый процесс получает геометрию сцены один раз при запуске (при fork - вообще без копирования),
+    а для каждого кадра - только набор преобразований. Кадры записываются на диск в процессах,
+    а имена файлов выдаются по порядку кадров по мере готовности.
+    Это генератор: кадры рисуются только во время перебора результата. При workers=1 кадры рисуются
+    в этом процессе на объектах самой сцены, и их transform возвращаются к исходным, только когда перебор
+    закончен или генератор закрыт (close() или удаление последней ссылки на него)
+    :param scene: сцена, ее рендер не используется, кадры рисует ZBufferRender размером с scene.view
+    :param schedule: по элементу на кадр: Transform для камеры или словарь {scene.view или объект: Transform},
+                     объектом может быть и потомок объекта сцены
+    :param output: имя файла кадра, {} заменяется номером кадра, расширение .png или .ppm
+    :param workers: количество процессов, по-умолчанию по количеству ядер, 1 - без процессов
+    :param bg: цвет фона
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    # объекты передаются в процессы номерами: -1 - камера, иначе номер в scene.nodes()
+    nodes = scene.nodes()
+    tasks = []
+    for i, frame in enumerate(schedule):
+        if isinstance(frame, Transform):
+            frame = {scene.view: frame}
+        plan = [(-1 if target is scene.view else nodes.index(target), transform)
+                for target, transform in frame.items()]
+        tasks.append((i, output.format(i), plan))
+
+    state = (scene.view, scene.objects, scene.flat_shading, scene.backface_cull, bg, scene.dtype, scene.lod_detail,
+             scene.frustum_cull)
+    if workers == 1:
+        # рисуем прямо здесь, а преобразования объектов потом возвращаем как было
+        targets = [scene.view] + nodes
+        saved = [[getattr(t.transform, name) for name in Transform.params] for t in targets]
+        try:
+            _animation_init(*state)
+            for task in tasks:
+                yield _animation_frame(task)
+        finally:
+            for t, values in zip(targets, saved):
+                for name, value in zip(Transform.params, values):
+                    setattr(t.transform, name, value)
+        return
+
+    # multiprocessing импортируем только здесь, он заметно замедляет импорт модуля
+    import multiprocessing
+
+    with multiprocessing.Pool(workers, initializer=_animation_init, initargs=state) as pool:
+        yield from pool.imap(_animation_frame, tasks)
+
+
+# сцена процесса, который рисует кадры анимации,
+# исходные параметры преобразований и номера объектов, измененных прошлым кадром
+_animation_scene = None
+_animation_start = None
+_animation_touched = []
+
+
+def _animation_init(view, objects, flat_shading, backface_cull, bg, dtype, lod_detail, frustum_cull):
+    global _animation_scene, _animation_start, _animation_touched
+    _animation_scene = Scene(view, ZBufferRender(view.w, view.h, bg=bg), flat_shading, backface_cull, frustum_cull,
+                             lod_detail, dtype=dtype)
+    _animation_scene.objects = objects
+    _animation_start = {index: Transform(*[getattr(t.transform, name) for name in Transform.params])
+                        for index, t in enumerate([view] + _animation_scene.nodes(), -1)}
+    _animation_touched = []
+
+
+def _animation_frame(task):
+    global _animation_touched
+    i, filename, plan = task
+    scene = _animation_scene
+    nodes = scene.nodes()
+
+    # каждый кадр считается от исходного положения сцены, независимо от того,
+    # какие кадры этот процесс рисовал до него
+    restore = [(index, _animation_start[index]) for index in _animation_touched]
+    for index, transform in restore + plan:
+        target = scene.view if index == -1 else nodes[index]
+        for name in Transform.params:
+            setattr(target.transform, name, getattr(transform, name))
+    _animation_touched = [index for index, transform in plan]
 
-# метод нажатия на кнопку ВЛЕВО
-def left():
-    model.transform.teta -= 0.1
     scene.draw()
+    scene.render.save(filename)
+    return filename
+
+
+# пример: звезда над плоскостью, вращается стрелками
+def main():
+    from tkinter import Tk, Canvas, Button, LEFT, RIGHT, TOP, BOTTOM, X, Y
+
+    w = 600
+    h = 400
+    v = View(w, h, d=200, persp=True)
+
+    # создаем объекты
+    root = Tk()
+
+    c = Canvas(root, width=w, height=h, bg='#00ff00')
+    c.pack()
+
+    scene = Scene(v, CanvasRender(c))
+    model = Star(pos=[0, 0, 0])
+    model.transform.teta = pi / 4
+    model.transform.phi = pi / 4
+    # cube = Cube(side=100, rot=[0.0, pi/5, 0], pos=[-400, -200, -100])
+    scene.add_object(Quad(800, 800, -300, color=(255, 255, 255)))
+    scene.add_object(model)
+    # scene.add_object(cube)
+
+    # метод нажатия на кнопку ВВЕРХ
+    def up():
+        model.transform.phi += 0.1
+        scene.draw()
+
+    # метод нажатия на кнопку ВНИЗ
+    def down():
+        model.transform.phi -= 0.1
+        scene.draw()
+
+    # метод нажатия на кнопку ВЛЕВО
+    def left():
+        model.transform.teta -= 0.1
+        scene.draw()
+
+    # метод нажатия на кнопку ВПРАВО
+    def right():
+        model.transform.teta += 0.1
+        scene.draw()
+
+    # реагируем на нажатия вверх-вниз-вправо-влево
+    def keypress(e):
+        if e.keysym == 'Up':
+            up()
+        elif e.keysym == 'Down':
+            down()
+        elif e.keysym == 'Left':
+            left()
+        elif e.keysym == 'Right':
+            right()
+
+    # регистрируем обработчик клавиатуры
+    root.bind('<Key>', keypress)
+
+    b1 = Button(text='Left', command=left, padx="80")
+    b1.pack(side=LEFT, fill=Y)
+
+    b2 = Button(text='Right', command=right, padx="80")
+    b2.pack(side=RIGHT, fill=Y)
+
+    b3 = Button(text='Up', command=up, pady="35")
+    b3.pack(side=TOP, fill=X)
+
+    b4 = Button(text='Down', command=down, pady="35")
+    b4.pack(side=BOTTOM, fill=X)
 
-
-# метод нажатия на кнопку ВПРАВО
-def right():
-    model.transform.teta -= 0.1
     scene.draw()
 
+    root.mainloop()
 
-# реагируем на нажатия вверх-вниз-вправо-влево
-def keypress(e):
-    if e.keysym == 'Up':
-        up()
-    elif e.keysym == 'Down':
-        down()
-    elif e.keysym == 'Left':
-        left()
-    elif e.keysym == 'Right':
-        right()
-
-
-
-# реагируем обработчик событий клавиатуры
-root.bind('<Key>', keypress)
-
-b1 = Button(text='Left', command=left, padx="80")
-b1.pack(side=LEFT, fill=Y)
-
-b2 = Button(text='Right', command=right, padx="80")
-b2.pack(side=RIGHT, fill=Y)
-
-b3 = Button(text='Up', command=up, pady="35")
-b3.pack(side=TOP, fill=X)
-
-b4 = Button(text='Down', command=down, pady="35")
-b4.pack(side=BOTTOM, fill=X)
-
-
-scene.draw()
-
-root.mainloop()
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import argparse
+
+from draw3d import *
+
+
+# углы камеры из строки "phi,teta,psi", в радианах
+def parse_angles(text):
+    angles = [float(a) for a in text.split(',')]
+    if len(angles) != 3:
+        raise argparse.ArgumentTypeError('нужно три угла: phi,teta,psi')
+    return angles
+
+
+# пакетная отрисовка obj модели в файлы без окна, по кадру на каждый набор углов камеры
+# python render_obj.py teddy.obj -a 0,0,0 -a 0,0.5,0 -o teddy_{:03d}.png
+# python render_obj.py teddy.obj --turntable 120 -o turntable/teddy_{:03d}.png
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Отрисовка obj модели в файлы PNG/PPM без окна')
+    parser.add_argument('model', help='obj файл или двоичный файл модели .mesh')
+    parser.add_argument('-o', '--output', default='frame_{:03d}.png',
+                        help='имя файла кадра, {} заменяется номером кадра, расширение .png или .ppm')
+    parser.add_argument('-a', '--angles', type=parse_angles, action='append',
+                        help='углы камеры phi,teta,psi в радианах, можно указать несколько раз')
+    parser.add_argument('--width', type=int, default=600, help='ширина кадра в пикселях')
+    parser.add_argument('--height', type=int, default=400, help='высота кадра в пикселях')
+    parser.add_argument('-d', type=float, default=100, help='константа для перспективного преобразования')
+    parser.add_argument('--ortho', action='store_true', help='выключить перспективу')
+    parser.add_argument('--scale', type=float, default=1.0, help='масштаб модели')
+    parser.add_argument('--bg', default='#00ff00', help='цвет фона')
+    parser.add_argument('--cull', action='store_true', help='отсекать невидимые грани')
+    parser.add_argument('--cache', action='store_true', help='хранить двоичную копию модели рядом с obj файлом')
+    parser.add_argument('--optimize', action='store_true', help='склеить вершины и переставить грани после загрузки')
+    parser.add_argument('--workers', type=int, default=1, help='процессов для разбора obj файла, 0 - по количеству ядер')
+    parser.add_argument('--turntable', type=int, metavar='N',
+                        help='N кадров полного оборота камеры вокруг модели, начиная с первого набора углов')
+    parser.add_argument('-j', '--jobs', type=int, default=0, help='процессов для отрисовки оборота, 0 - по количеству ядер')
+    args = parser.parse_args(argv)
+
+    view = View(args.width, args.height, d=args.d, persp=not args.ortho)
+    render = ZBufferRender(args.width, args.height, bg=args.bg)
+    scene = Scene(view, render, backface_cull=args.cull)
+    scene.add_object(ObjMesh(args.model, scale=[args.scale] * 3, cache=args.cache, workers=args.workers or None,
+                             optimize=args.optimize))
+
+    if args.turntable:
+        view.transform.phi, view.transform.teta, view.transform.psi = (args.angles or [[0.0, 0.0, 0.0]])[0]
+        schedule = turntable(view.transform, args.turntable)
+        for filename in iter_animation(scene, schedule, args.output, args.jobs or None, args.bg):
+            print(filename)
+        return
+
+    for i, (phi, teta, psi) in enumerate(args.angles or [[0.0, 0.0, 0.0]]):
+        view.transform.phi = phi
+        view.transform.teta = teta
+        view.transform.psi = psi
+        scene.draw()
+
+        filename = args.output.format(i)
+        render.save(filename)
+        print(filename)
+
+
+if __name__ == '__main__':
+    main()